@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+'''
+Asyncio client for the Bookworm API.
+
+Every process runs one event loop on a background thread, with one aiohttp
+session that keeps its connections to Bookworm alive. Both are started on
+first use, so each gunicorn worker gets its own after the fork. Callback
+threads hand their requests to the loop and wait for the answer; the waiting
+is cheap, so with gunicorn's threaded workers one process can have many
+Bookworm queries in flight.
+
+AsyncQuery is a drop-in BWQuery: run() returns the same BWResults, and
+run_all() runs several queries at once.
+'''
+import asyncio
+import json
+import logging
+import os
+import threading
+
+import aiohttp
+import bwypy
+
+limit = 32
+# Seconds per request: a hung Bookworm must fail queries (and trip the circuit
+# breaker, see queries.py) rather than hold their admission slots forever
+timeout = 30
+
+_loop = None
+_session = None
+_lock = threading.Lock()
+
+def configure(max_connections=None, request_timeout=None):
+    global limit, timeout
+    if max_connections is not None:
+        limit = max_connections
+    if request_timeout is not None:
+        timeout = request_timeout
+
+def loop():
+    ''' The process's event loop, started on first use '''
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='bookworm-io', daemon=True).start()
+    return _loop
+
+def call(coroutine):
+    ''' Run a coroutine on the event loop and wait for its result '''
+    return asyncio.run_coroutine_threadsafe(coroutine, loop()).result()
+
+async def session():
+    # Only touched from the loop's own thread, so needs no lock
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit),
+                                         timeout=aiohttp.ClientTimeout(total=timeout))
+    return _session
+
+async def fetch(endpoint, query, verify=True):
+    client = await session()
+    params = { 'queryTerms': json.dumps(query) }
+    async with client.get(endpoint, params=params, ssl=None if verify else False) as response:
+        response.raise_for_status()
+        # Bookworm does not always send a JSON content type
+        return await response.json(content_type=None)
+
+class AsyncQuery(bwypy.BWQuery):
+    def __init__(self, *args, verify_cert=True, **kwargs):
+        super().__init__(*args, verify_cert=verify_cert, **kwargs)
+        self.verify = verify_cert
+
+    def _fetch(self, query):
+        return call(fetch(self.endpoint, query, self.verify))
+
+    async def run_async(self):
+        ''' Same as run(), but awaitable '''
+        self._validate()
+        self._runtime_validate()
+        logging.debug("Running " + json.dumps(self.json))
+        json_response = await fetch(self.endpoint, self.json, self.verify)
+        return bwypy.BWResults(json_response, self.json, self._dtypes)
+
+def run_all(queries):
+    ''' Run several queries concurrently, returning their results in order '''
+    async def gather():
+        return await asyncio.gather(*[query.run_async() for query in queries])
+    return call(gather())
+
+def _after_fork():
+    # The loop's thread does not survive a fork, and the session's sockets
+    # must not be shared with the parent
+    global _loop, _session, _lock
+    _loop = None
+    _session = None
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+'''
+Cacheable GET endpoints that return figure JSON, e.g.
+
+    /app/api/map?word=color&compare=colour&scope=country&type=scattergeo
+    /app/api/heatmap?word=computer&facet=lc_classes&min_year=1900&max_year=2000
+    /app/api/bar?group=languages&trim=20&drop=drop&counttype=TextCount
+
+Requests are redirected to a canonical URL (fixed parameter order, defaults
+filled in, normalized word lists) so that a reverse proxy or browser cache
+sees every equivalent query as the same resource.
+'''
+import json
+import logging
+from urllib.parse import urlencode
+
+import plotly
+from flask import request, redirect, abort, Response
+
+import cache
+from common import app
+import figures
+from queries import BackendBusy, BackendUnavailable, NoResults, UnknownWords, breaker_reset, settings, facet_opts, split_words
+
+server = app.server
+api_path = app.config['url_base_pathname'] + 'api/'
+
+# Figures only change when the Bookworm index is rebuilt
+max_age = settings.get('api_max_age', 86400)
+
+facet_names = [option['value'] for option in facet_opts]
+
+def normalize_words(word):
+    # Bookworm queries are case insensitive and sum over the word list, so
+    # order and repeats don't change the figure
+    words = sorted(set(token.lower() for token in split_words(word or '') if token))
+    return ','.join(words)
+
+def choice(name, options, default):
+    value = request.args.get(name, default)
+    if value not in options:
+        abort(400, "'%s' must be one of: %s" % (name, ', '.join(map(str, options))))
+    return value
+
+def integer(name, default, low, high):
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        abort(400, "'%s' must be an integer" % name)
+    return min(max(value, low), high)
+
+def canonical(endpoint, params):
+    ''' Redirect to the canonical URL, or return it if this is already the one requested '''
+    url = api_path + endpoint + '?' + urlencode(params)
+    # Compare the decoded arguments rather than the raw query string, which a
+    # proxy may re-encode (e.g. %2C for ',')
+    if list(request.args.items(multi=True)) != [(name, str(value)) for name, value in params]:
+        return url, redirect(url, code=301)
+    return url, None
+
+def figure_response(fig, url):
+    response = Response(json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder),
+                        mimetype='application/json')
+    response.headers['Cache-Control'] = 'public, max-age=%d' % max_age
+    response.headers['Link'] = '<%s>; rel="canonical"' % url
+    response.add_etag()
+    return response.make_conditional(request)
+
+@server.route(api_path + 'map')
+def api_map():
+    word = normalize_words(request.args.get('word'))
+    if not word:
+        abort(400, "'word' is required")
+    params = [('word', word),
+              ('compare', normalize_words(request.args.get('compare'))),
+              ('type', choice('type', figures.map_types, 'scattergeo')),
+              ('scope', choice('scope', figures.map_scopes, 'country'))]
+    url, response = canonical('map', params)
+    if response is None:
+        q = dict(params)
+        fig = figures.map_figure(q['word'], q['compare'], q['type'], q['scope'])
+        response = figure_response(fig, url)
+    return response
+
+@server.route(api_path + 'heatmap')
+def api_heatmap():
+    word = normalize_words(request.args.get('word'))
+    if not word:
+        abort(400, "'word' is required")
+    # An empty 'values' list shows every facet value the query returns
+    values = sorted(set(value for value in request.args.get('values', '').split(',') if value))
+    params = [('word', word),
+              ('facet', choice('facet', facet_names, 'lc_classes')),
+              ('values', ','.join(values)),
+              ('min_year', integer('min_year', figures.default_min_year, figures.hard_min_year, figures.hard_max_year)),
+              ('max_year', integer('max_year', figures.default_max_year, figures.hard_min_year, figures.hard_max_year))]
+    url, response = canonical('heatmap', params)
+    if response is None:
+        q = dict(params)
+        fig = figures.heatmap_figure(q['word'], q['facet'], tuple(values), (q['min_year'], q['max_year']))
+        response = figure_response(fig, url)
+    return response
+
+@server.route(api_path + 'bar')
+def api_bar():
+    params = [('group', choice('group', facet_names, 'languages')),
+              ('trim', integer('trim', 20, 10, 60)),
+              ('drop', choice('drop', ['drop', 'keep'], 'drop')),
+              ('counttype', choice('counttype', figures.count_types, 'TextCount'))]
+    url, response = canonical('bar', params)
+    if response is None:
+        q = dict(params)
+        fig = figures.bar_figure(q['group'], q['trim'], q['drop'], q['counttype'])
+        response = figure_response(fig, url)
+    return response
+
+@server.errorhandler(BackendBusy)
+def api_busy(error):
+    return Response(json.dumps(dict(error='The Bookworm server is busy right now. Please try again in a moment!')),
+                    status=503, mimetype='application/json',
+                    headers={'Cache-Control': 'no-store', 'Retry-After': '10'})
+
+@server.errorhandler(BackendUnavailable)
+def api_unavailable(error):
+    return Response(json.dumps(dict(error='The Bookworm server is not responding. Please try again in a minute!')),
+                    status=503, mimetype='application/json',
+                    headers={'Cache-Control': 'no-store', 'Retry-After': str(breaker_reset)})
+
+@server.errorhandler(NoResults)
+def api_no_results(error):
+    # Cacheable for as long as the negative result cache keeps it
+    body = dict(error='No results for \'%s\'' % error.args[0])
+    if isinstance(error, UnknownWords):
+        body['suggestions'] = error.suggestions
+    return Response(json.dumps(body),
+                    status=404, mimetype='application/json',
+                    headers={'Cache-Control': 'public, max-age=%d' % cache.negative_ttl})
+
+@server.errorhandler(500)
+def api_error(error):
+    if request.path.startswith(api_path):
+        logging.error(json.dumps(dict(page='api', path=request.full_path)),
+                      exc_info=getattr(error, 'original_exception', None))
+        return Response(json.dumps(dict(error='There was an error! We\'ve logged it and will try to fix it.')),
+                        status=500, mimetype='application/json', headers={'Cache-Control': 'no-store'})
+    return error
@@ -5,9 +5,10 @@ from dash.dependencies import Input, Output
 import plotly
 import plotly.graph_objs as go
 import pandas as pd
-from common import app
+from common import app, graphconfig
 from tools import load_page
 import json
+from urllib.parse import unquote
 
 server = app.server
 
@@ -18,9 +19,20 @@ page_info = [
 ]
 pages = { page['slug']: load_page(page['path']+'.py') for page in page_info }
 
+# Registers the GET figure and data export APIs on the server
+import api
+import export
+import profiling
+import topology
+
 with open('config.json','r') as options_file:
     header_options = json.load(options_file)
 
+# Opt-in per-request profiling, only installed when a profiling_token is configured
+profiling.init_app(server, header_options['settings'], app.config["url_base_pathname"])
+# Map topology from data/topojson instead of the Plotly CDN, when it has been fetched
+topology.init_app(server, graphconfig, app.config["url_base_pathname"])
+
 header_bar = html.Nav(className='navbar navbar-dark bg-dark navbar-expand-lg px-3', children=[
             dcc.Link("Bookworm Playground", href=app.config["url_base_pathname"], className="navbar-brand", style=dict(color='#fff')),
             html.Ul(className="navbar-nav", children=
@@ -54,14 +66,15 @@ app.layout = html.Div([
         html.Div(dcc.Markdown(footer), className='container px-3')
 ])
 
-# Future support for params with /q= at the end
+# Params with /q= at the end, e.g. /app/map/q=color+hue,colour
+# Commas separate params, so '+' joins the words of a multi-word search
 def parse_path(pathname):
     try:
-        pathparts = pathname.strip('/').split('/')
+        pathparts = unquote(pathname).strip('/').split('/')
     except:
         return None, None
     if pathparts[-1].startswith('q='):
-        params = pathparts[-1][2:].split(',')
+        params = [param.replace('+', ',') for param in pathparts[-1][2:].split(',')]
         pathparts = pathparts[:-1]
     else:
         params = None
@@ -78,9 +91,9 @@ def display_page(pathname):
         if not (pathparts[0] == app.config["url_base_pathname"].strip('/')):
             raise Exception('Unknown page')
         if (len(pathparts) == 1):
-            return pages['map']
+            return pages['map'](params)
         if pathparts[1] in pages:
-            return pages[pathparts[1]]
+            return pages[pathparts[1]](params)
         else:
             raise Exception('Unknown page')
     except:
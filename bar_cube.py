@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+Materialized facet x date_year x {TextCount, WordCount} cube for the bar chart.
+
+Everything the bar chart shows is a corpus-wide count that only changes when
+the Bookworm index is rebuilt, so it is exported once into a local Arrow file
+and served from a memory map instead of the live endpoint.
+
+Rebuild the cube after every index rebuild with:
+
+    python bar_cube.py [--output data/bar_cube.arrow]
+
+Running workers pick up a rebuilt cube on their next bar chart query.
+'''
+import argparse
+import functools
+import json
+import logging
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+CUBE_PATH = 'data/bar_cube.arrow'
+
+# Same cut-off as the live bar chart query
+MAX_FACET_ID = 60
+
+schema = pa.schema([
+    ('facet', pa.dictionary(pa.int16(), pa.string())),
+    ('value', pa.string()),
+    # null for the facet totals, set for the per-year breakdown
+    ('date_year', pa.int16()),
+    ('TextCount', pa.int64()),
+    ('WordCount', pa.int64()),
+    # True for values that bwypy's drop_unknowns would remove
+    ('unknown', pa.bool_()),
+])
+
+def _facet_rows(bw, group):
+    ''' Query the totals and the per-year breakdown for a single facet. '''
+    limits = { group + '__id': { '$lt': MAX_FACET_ID } }
+
+    bw.counttype = ['WordCount', 'TextCount']
+    bw.groups = ['*'+group]
+    bw.search_limits = limits
+    results = bw.run()
+    totals = results.frame(index=False, drop_unknowns=False)
+    totals.columns = ['value', 'WordCount', 'TextCount']
+    known = results.frame(index=False, drop_unknowns=True)
+    totals['unknown'] = ~totals['value'].isin(known.iloc[:, 0])
+    totals['date_year'] = None
+
+    bw.counttype = ['TextCount', 'WordCount']
+    bw.groups = [group, 'date_year']
+    bw.search_limits = limits
+    years = bw.run().frame(index=False, drop_unknowns=False)
+    years.columns = ['value', 'date_year', 'TextCount', 'WordCount']
+    years['date_year'] = pd.to_numeric(years['date_year'])
+    years['unknown'] = years['value'].isin(totals.loc[totals.unknown, 'value'])
+    years = years.sort_values(['value', 'date_year'])
+
+    # Totals keep the backend's ordering, so the cube can be read back as-is
+    rows = pd.concat([totals, years], ignore_index=True)
+    rows['facet'] = group
+    return rows[schema.names]
+
+def materialize(path=CUBE_PATH):
+    import bwypy
+    from tools import get_facet_group_options
+
+    with open('config.json','r') as options_file:
+        bwypy_options = json.load(options_file)
+
+    bwypy.set_options(database=bwypy_options['settings']['dbname'], endpoint=bwypy_options['settings']['endpoint'])
+    bw = bwypy.BWQuery(verify_fields=False,verify_cert=False)
+
+    facets = []
+    batches = []
+    offset = 0
+    for option in get_facet_group_options(bw):
+        logging.info("Materializing %s" % option['value'])
+        rows = _facet_rows(bw, option['value'])
+        batch = pa.RecordBatch.from_pandas(rows, schema=schema, preserve_index=False)
+        facets.append(dict(option, offset=offset, length=batch.num_rows))
+        batches.append(batch)
+        offset += batch.num_rows
+
+    # Write next to the target and swap, so running workers never see a partial file
+    metadata = { 'facets': json.dumps(facets) }
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema.with_metadata(metadata)) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    os.replace(tmp_path, path)
+    return facets
+
+def available(path=CUBE_PATH):
+    return os.path.exists(path)
+
+def version(path=CUBE_PATH):
+    ''' The cube's modification time, or None if there is no cube '''
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+@functools.lru_cache(maxsize=1)
+def load_cube(path=CUBE_PATH, mtime=None):
+    ''' Memory-map the cube. Columns are read lazily and shared between workers by the page cache.
+    mtime is only part of the cache key, so a rebuilt cube is reloaded. '''
+    source = pa.memory_map(path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+    facets = json.loads(table.schema.metadata[b'facets'])
+    return table, { facet['value']: facet for facet in facets }
+
+def preload(path=CUBE_PATH):
+    ''' Map the cube now, e.g. in the gunicorn master so that workers inherit it '''
+    if available(path):
+        load_cube(path, version(path))
+
+def facet_group_options(path=CUBE_PATH):
+    table, facets = load_cube(path, version(path))
+    return [{'label': facet['label'], 'value': facet['value']} for facet in facets.values()]
+
+def _facet_frame(group, path=CUBE_PATH):
+    table, facets = load_cube(path, version(path))
+    facet = facets[group]
+    return table.slice(facet['offset'], facet['length']).drop(['facet']).to_pandas()
+
+def get_results(group, drop_unknowns=False, path=CUBE_PATH):
+    ''' Equivalent of get_results(group).frame(index=False, drop_unknowns=...) in the bar chart '''
+    df = _facet_frame(group, path)
+    df = df[df.date_year.isnull()]
+    if drop_unknowns:
+        df = df[~df.unknown]
+    return df.rename(columns={'value': group})[[group, 'WordCount', 'TextCount']].reset_index(drop=True)
+
+def get_date_distribution(group, facet, path=CUBE_PATH):
+    ''' TextCount by date_year for a single facet value '''
+    df = _facet_frame(group, path)
+    df = df[df.date_year.notnull() & (df.value == facet)]
+    df = df.rename(columns={'value': group})[[group, 'date_year', 'TextCount']].reset_index(drop=True)
+    df.date_year = df.date_year.astype(int)
+    return df
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Export the bar chart facet cube from Bookworm.')
+    parser.add_argument('--output', default=CUBE_PATH, help='Arrow file to write (default: %(default)s)')
+    args = parser.parse_args()
+    facets = materialize(args.output)
+    print("Wrote %d facets to %s" % (len(facets), args.output))
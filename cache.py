@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+'''
+Result cache shared by the app's workers and the precompute tool.
+
+Results are kept in a small per-process LRU and pickled under `cache_dir`, so a
+result computed by one gunicorn worker, or ahead of time by precompute.py, is a
+cache hit for every other process.
+
+Entries older than `ttl` seconds are stale: they are still served immediately,
+while a background thread recomputes them (stale-while-revalidate).
+
+The directory is kept under `max_size` bytes by deleting the entries that were
+written longest ago.
+
+A result being computed is marked with an `.inflight` file next to its entry,
+so other processes wait for it instead of sending the same queries again.
+Markers older than `inflight_timeout` seconds are left by a process that died,
+and ignored.
+
+Failures are cached too, for `negative_ttl` seconds, so a misspelled word or a
+failing query is not sent to Bookworm again on every retry. Exceptions derived
+from `Transient` (load shedding, an open circuit breaker) are never cached.
+'''
+import collections
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+cache_dir = 'cache'
+ttl = 7*24*3600
+negative_ttl = 60
+# Size bound of the on-disk cache in bytes, checked every prune_interval stores
+max_size = None
+prune_interval = 200
+inflight_timeout = 120
+poll_interval = 0.1
+
+MISSING = object()
+
+Entry = collections.namedtuple('Entry', ['stored_at', 'value'])
+# Stored as an Entry value when the function raised
+Failure = collections.namedtuple('Failure', ['error'])
+
+class Transient(Exception):
+    ''' Base class for errors that say nothing about the query, so are not cached '''
+
+# Keys with a background refresh in flight, so each is only refreshed once
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+# Set inside refresh threads: nested lookups must not serve stale data there
+_local = threading.local()
+_stores = 0
+_prune_lock = threading.Lock()
+_pruning = threading.Event()
+
+def _after_fork():
+    # Refresh threads do not survive a fork, so neither does their bookkeeping
+    global _refreshing, _refreshing_lock, _prune_lock, _pruning
+    _refreshing = set()
+    _refreshing_lock = threading.Lock()
+    _prune_lock = threading.Lock()
+    _pruning = threading.Event()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def configure(directory, max_age=None, negative_max_age=None, max_megabytes=None):
+    global cache_dir, ttl, negative_ttl, max_size
+    cache_dir = directory
+    if max_megabytes is not None:
+        max_size = max_megabytes * 2**20
+    if max_age is not None:
+        ttl = max_age
+    if negative_max_age is not None:
+        negative_ttl = negative_max_age
+
+def _path(name, key):
+    # repr() of the str/int/tuple arguments is stable across processes
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name, digest[:2], digest + '.pkl')
+
+def load(name, key):
+    try:
+        with open(_path(name, key), 'rb') as cache_file:
+            entry = pickle.load(cache_file)
+    except FileNotFoundError:
+        return MISSING
+    except Exception:
+        logging.exception("Unreadable cache entry for %s%r" % (name, key))
+        return MISSING
+    return entry if isinstance(entry, Entry) else MISSING
+
+def store(name, key, entry):
+    path = _path(name, key)
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file and swap, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump(entry, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except Exception:
+        logging.exception("Could not cache %s%r" % (name, key))
+    _maybe_prune()
+
+def _marker(name, key):
+    return _path(name, key)[:-len('.pkl')] + '.inflight'
+
+def claim(name, key):
+    ''' Mark the entry as being computed. False if some process is computing it already. '''
+    marker = _marker(name, key)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    while True:
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.stat(marker).st_mtime <= inflight_timeout:
+                return False
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+
+def release(name, key):
+    try:
+        os.remove(_marker(name, key))
+    except FileNotFoundError:
+        pass
+
+def await_entry(name, key):
+    ''' The entry another process is computing, or MISSING if it stored no fresh one '''
+    marker = _marker(name, key)
+    deadline = time.time() + inflight_timeout
+    while os.path.exists(marker) and time.time() < deadline:
+        time.sleep(poll_interval)
+    entry = load(name, key)
+    if entry is MISSING or is_stale(entry) or is_expired(entry):
+        return MISSING
+    return entry
+
+def prune(max_bytes):
+    ''' Delete the least recently written entries until the cache fits in max_bytes '''
+    files = []
+    for directory, _, names in os.walk(cache_dir):
+        for file_name in names:
+            try:
+                stat = os.stat(os.path.join(directory, file_name))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, os.path.join(directory, file_name)))
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logging.info("Pruned %d cache entries, %d MB left" % (removed, total // 2**20))
+    return removed
+
+def _maybe_prune():
+    global _stores
+    if max_size is None:
+        return
+    with _prune_lock:
+        _stores += 1
+        if _stores % prune_interval or _pruning.is_set():
+            return
+        _pruning.set()
+    def run():
+        try:
+            prune(max_size)
+        except Exception:
+            logging.exception("Could not prune the cache")
+        finally:
+            _pruning.clear()
+    threading.Thread(target=run, daemon=True).start()
+
+def is_failure(entry):
+    return isinstance(entry.value, Failure)
+
+def is_stale(entry):
+    return time.time() - entry.stored_at > ttl
+
+def is_expired(entry):
+    # Failures are retried rather than served stale
+    return is_failure(entry) and time.time() - entry.stored_at > negative_ttl
+
+def cached(name, maxsize=32, persist=True):
+    ''' Like functools.lru_cache, but backed by the shared on-disk cache unless persist is False '''
+    def decorator(func):
+        signature = inspect.signature(func)
+        memory = OrderedDict()
+        lock = threading.Lock()
+
+        def restore(key):
+            return load(name, key) if persist else MISSING
+
+        def save(key, entry):
+            if persist:
+                store(name, key, entry)
+
+        def cache_key(*args, **kwargs):
+            # Normalize positional vs. keyword arguments and fill in defaults
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return tuple(bound.arguments.values())
+
+        def remember(key, entry):
+            with lock:
+                memory[key] = entry
+                memory.move_to_end(key)
+                if len(memory) > maxsize:
+                    memory.popitem(last=False)
+
+        def compute(key, args, kwargs, negative=True):
+            claimed = persist and claim(name, key)
+            if persist and not claimed:
+                entry = await_entry(name, key)
+                if entry is not MISSING:
+                    remember(key, entry)
+                    if is_failure(entry):
+                        raise entry.value.error.with_traceback(None)
+                    return entry
+                # It was not cached after all (e.g. shed), so try here
+            try:
+                try:
+                    entry = Entry(time.time(), func(*args, **kwargs))
+                except Transient:
+                    raise
+                except Exception as error:
+                    if negative:
+                        entry = Entry(time.time(), Failure(error))
+                        save(key, entry)
+                        remember(key, entry)
+                    raise
+                save(key, entry)
+            finally:
+                # Only once the entry is on disk, for the processes waiting on it
+                if claimed:
+                    release(name, key)
+            remember(key, entry)
+            return entry
+
+        def refresh(key, args, kwargs):
+            _local.refreshing = True
+            try:
+                # A failed refresh must not replace the stale but good entry
+                compute(key, args, kwargs, negative=False)
+                logging.debug("Refreshed %s%r" % (name, key))
+            except Exception:
+                # Keep serving the stale entry; the next hit tries again
+                logging.warning("Background refresh of %s%r failed" % (name, key), exc_info=True)
+            finally:
+                with _refreshing_lock:
+                    _refreshing.discard((name, key))
+
+        def revalidate(key, args, kwargs):
+            with _refreshing_lock:
+                if (name, key) in _refreshing:
+                    return
+                _refreshing.add((name, key))
+            threading.Thread(target=refresh, args=(key, args, kwargs), daemon=True).start()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = cache_key(*args, **kwargs)
+            with lock:
+                entry = memory.get(key, MISSING)
+            if entry is MISSING:
+                entry = restore(key)
+                if entry is not MISSING:
+                    remember(key, entry)
+
+            if entry is MISSING or is_expired(entry):
+                entry = compute(key, args, kwargs)
+            elif is_failure(entry):
+                raise entry.value.error.with_traceback(None)
+            elif is_stale(entry):
+                if getattr(_local, 'refreshing', False):
+                    entry = compute(key, args, kwargs)
+                else:
+                    revalidate(key, args, kwargs)
+            return entry.value
+
+        def is_cached(*args, **kwargs):
+            ''' True if a call would be answered without computing '''
+            key = cache_key(*args, **kwargs)
+            with lock:
+                entry = memory.get(key, MISSING)
+            if entry is MISSING:
+                entry = restore(key)
+            return entry is not MISSING and not is_expired(entry)
+
+        def put(value, *args, **kwargs):
+            ''' Cache value as the result of a call, e.g. one computed as part of a batch '''
+            key = cache_key(*args, **kwargs)
+            entry = Entry(time.time(), value)
+            save(key, entry)
+            remember(key, entry)
+
+        wrapper.cache_key = cache_key
+        wrapper.is_cached = is_cached
+        wrapper.put = put
+        return wrapper
+    return decorator
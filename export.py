@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+Streaming bulk export of the data behind the figures, e.g.
+
+    /app/api/export/heatmap?word=computer&facets=lc_classes,languages&format=csv
+    /app/api/export/map?word=color&scopes=country,state&format=arrow
+    /app/api/export/bar?groups=languages,genres&drop=keep
+
+The search words and the backend's availability are checked before the
+response starts, so unknown words get a 404 and an open circuit breaker a 503.
+Facets (or scopes) are then queried one at a time and written out in chunks,
+so a large multi-facet export is never held in memory as a whole file. Arrow
+exports use the IPC streaming format.
+'''
+import io
+import logging
+
+import pyarrow as pa
+from flask import request, abort, Response, stream_with_context
+
+from common import app
+import figures
+from api import api_path, facet_names, normalize_words
+import bar_cube
+from queries import check_available, check_words, get_word_by_country, get_word_by_us_state, get_heatmap_values, get_results
+
+server = app.server
+
+chunk_rows = 5000
+
+schemas = {
+    'heatmap': pa.schema([('word', pa.string()), ('facet', pa.string()), ('value', pa.string()),
+                          ('date_year', pa.int32()), ('WordsPerMillion', pa.float64())]),
+    'map': pa.schema([('word', pa.string()), ('scope', pa.string()), ('location', pa.string()),
+                      ('code', pa.string()), ('WordsPerMillion', pa.float64())]),
+    'bar': pa.schema([('facet', pa.string()), ('value', pa.string()),
+                      ('WordCount', pa.int64()), ('TextCount', pa.int64())]),
+}
+
+def heatmap_frames(word, facets):
+    for facet in facets:
+        df = get_heatmap_values(word, facet, figures.max_facet_values,
+                                hard_min_year=figures.hard_min_year, hard_max_year=figures.hard_max_year)
+        df = df.rename(columns={facet: 'value'})
+        yield df.assign(word=word, facet=facet)
+
+def map_frames(word, scopes):
+    for scope in scopes:
+        if scope == 'country':
+            df = get_word_by_country(word).rename(columns={'publication_country': 'location'})
+        else:
+            df = get_word_by_us_state(word).rename(columns={'publication_state': 'location'})
+        yield df.assign(word=word, scope=scope)
+
+def bar_frames(groups, drop_unknowns):
+    for group in groups:
+        df = get_results(group, drop_unknowns).rename(columns={group: 'value'})
+        yield df.assign(facet=group)
+
+def logged(frames):
+    ''' Log a failure past the response headers, which the client only sees as a truncated file '''
+    try:
+        yield from frames
+    except Exception:
+        logging.exception("Export of %s failed after the response started" % request.full_path)
+        raise
+
+def chunks(frames, schema):
+    for df in frames:
+        df = df[schema.names].reset_index(drop=True)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start+chunk_rows]
+
+class _Drain(io.RawIOBase):
+    ''' Write-only sink that hands back whatever has been written since the last drain '''
+    def __init__(self):
+        self.buffer = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        return data
+
+def csv_stream(frames, schema):
+    header = True
+    for chunk in chunks(frames, schema):
+        yield chunk.to_csv(index=False, header=header)
+        header = False
+    if header:
+        yield ','.join(schema.names) + '\n'
+
+def arrow_stream(frames, schema):
+    sink = _Drain()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        yield sink.drain()
+        for chunk in chunks(frames, schema):
+            writer.write_batch(pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False))
+            yield sink.drain()
+    yield sink.drain()
+
+formats = {
+    'csv': (csv_stream, 'text/csv', 'csv'),
+    'arrow': (arrow_stream, 'application/vnd.apache.arrow.stream', 'arrow'),
+}
+
+def names(arg, options, default):
+    values = [value for value in request.args.get(arg, default).split(',') if value]
+    unknown = [value for value in values if value not in options]
+    if unknown or not values:
+        abort(400, "'%s' must be a comma separated list of: %s" % (arg, ', '.join(options)))
+    return values
+
+@server.route(api_path + 'export/<kind>')
+def export(kind):
+    if kind not in schemas:
+        abort(404)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in formats:
+        abort(400, "'format' must be one of: %s" % ', '.join(formats))
+
+    if kind == 'bar':
+        if not bar_cube.available():
+            check_available()
+        frames = bar_frames(names('groups', facet_names, 'languages'), request.args.get('drop', 'drop') == 'drop')
+        filename = 'bar'
+    else:
+        word = normalize_words(request.args.get('word'))
+        if not word:
+            abort(400, "'word' is required")
+        # The cheap checks that can fail the whole export go before the
+        # response starts; the queries themselves are made while streaming
+        check_words(word)
+        check_available()
+        if kind == 'heatmap':
+            frames = heatmap_frames(word, names('facets', facet_names, 'lc_classes'))
+        else:
+            frames = map_frames(word, names('scopes', figures.map_scopes, 'country'))
+        filename = '%s-%s' % (kind, word.replace(',', '+'))
+
+    logging.debug("Exporting %s as %s" % (request.full_path, fmt))
+    stream, mimetype, extension = formats[fmt]
+    return Response(stream_with_context(stream(logged(frames), schemas[kind])), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename="%s.%s"' % (filename, extension)})
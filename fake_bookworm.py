@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+'''
+Stand-in Bookworm HTTP endpoint for load testing (see loadtest.py).
+
+Answers the `?queryTerms=<json>` requests bwypy sends with synthetic but
+deterministic counts, after a configurable delay and with a configurable
+share of failures:
+
+    python fake_bookworm.py --port 10014 --latency 0.3 --jitter 0.2 --error-rate 0.01
+'''
+import argparse
+import hashlib
+import json
+import random
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+with open('data/map_to_human_readable.json', 'r') as map_to_human_readable_file:
+    labelled = json.load(map_to_human_readable_file)
+
+values = {
+    'publication_country': pd.read_csv('data/country_codes.csv').publication_country.tolist(),
+    'publication_state': pd.read_csv('data/state_codes_us.csv').publication_state.tolist(),
+    'lc_classes': list('ABCDEFGHJKLMNPQRSTUVZ'),
+    'is_gov_doc': ['0', '1'],
+}
+values.update({ facet: list(labels.keys()) for facet, labels in labelled.items() })
+
+fields = [{'name': name, 'type': 'character', 'dbname': name, 'description': name} for name in values]
+fields.append({'name': 'date_year', 'type': 'integer', 'dbname': 'date_year', 'description': 'date_year'})
+
+latency = 0.0
+jitter = 0.0
+error_rate = 0.0
+
+def group_values(group, limits):
+    group = group.lstrip('*')
+    if group == 'date_year':
+        years = limits.get('date_year', {})
+        low = years.get('$gt', 1649) + 1 if isinstance(years, dict) else 1650
+        high = years.get('$lt', 2016) if isinstance(years, dict) else 2016
+        return [str(year) for year in range(low, high)]
+    options = values.get(group, ['%s %d' % (group, n) for n in range(50)])
+    limit = limits.get(group + '__id', {}).get('$lt')
+    return options[:limit - 1] if limit else options
+
+def counts(query):
+    ''' Nested {group value: ... [counts]} response, deterministic per query '''
+    limits = query.get('search_limits', {})
+    groups = query.get('groups', [])
+    if not isinstance(groups, list):
+        groups = [groups]
+    counttypes = query.get('counttype', ['TextCount', 'WordCount'])
+    seed = hashlib.sha1(json.dumps(limits.get('word', []), sort_keys=True).encode('utf-8')).hexdigest()
+    rng = random.Random(seed)
+
+    def expand(groups):
+        if not groups:
+            return [round(rng.expovariate(0.05), 3) if counttype == 'WordsPerMillion' else rng.randint(0, 100000)
+                    for counttype in counttypes]
+        return { value: expand(groups[1:]) for value in group_values(groups[0], limits) }
+    return expand(groups)
+
+def search_results(query):
+    return ['<a href=https://hdl.handle.net/2027/fake.%d><em>Example book %d</em> (%d)</a>' % (n, n, 1800 + n)
+            for n in range(10)]
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(max(0.0, random.gauss(latency, jitter)))
+        if random.random() < error_rate:
+            self.send_error(500, 'Synthetic failure')
+            return
+        try:
+            query = json.loads(parse_qs(urlparse(self.path).query)['queryTerms'][0])
+        except (KeyError, ValueError):
+            self.send_error(400, 'Expected ?queryTerms=<json>')
+            return
+
+        method = query.get('method', 'return_json')
+        if method == 'returnPossibleFields':
+            body = fields
+        elif method == 'search_results':
+            body = search_results(query)
+        else:
+            body = counts(query)
+
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    global latency, jitter, error_rate
+    parser = argparse.ArgumentParser(description='Fake Bookworm endpoint for load tests.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10014)
+    parser.add_argument('--latency', type=float, default=0.2, help='mean response delay in seconds (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.1, help='std. deviation of the delay (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests that fail with a 500 (default: %(default)s)')
+    args = parser.parse_args()
+    latency, jitter, error_rate = args.latency, args.jitter, args.error_rate
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print("Fake Bookworm listening on http://%s:%d/" % (args.host, args.port), flush=True)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+'''
+Figure builders shared by the page callbacks and the figure API.
+'''
+import itertools
+import logging
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+from plotly import figure_factory as FF
+
+from cache import cached
+from queries import (get_word_by_country, get_word_by_us_state, get_heatmap_values,
+                     get_results, get_date_distribution, labelled_facets)
+from tools import pretty_facet, map_to_human_readable, human_readable_labels, ld_values
+
+map_types = ['scattergeo', 'choropleth']
+map_scopes = ['country', 'state']
+# The map page's word, compare word, type and scope, in its /q= URL order
+map_defaults = ['color', 'colour', 'scattergeo', 'country']
+
+hard_min_year = 1650
+hard_max_year = 2015
+default_min_year = 1900
+default_max_year = 2000
+max_facet_values = 30
+# Facet values in the quick first heatmap of progressive rendering
+coarse_facet_values = 5
+
+count_types = ['TextCount', 'WordCount']
+
+def build_map(word, compare_word=None, type='scattergeo', scope='country'):
+    transform = lambda x: np.log(1+x/maxval)
+
+    if scope == 'country':
+        data = get_word_by_country(word).copy()
+        if compare_word:
+            data2 = get_word_by_country(compare_word).copy()
+        field = 'publication_country'
+        scope = 'world'
+        projection = 'Mercator'
+        locationmode = 'ISO-3'
+    elif scope == 'state':
+        data = get_word_by_us_state(word).copy()
+        if compare_word:
+            data2 = get_word_by_us_state(compare_word).copy()
+        field = 'publication_state'
+        scope = 'usa'
+        projection = 'albers usa'
+        locationmode = 'USA-states'
+
+    if compare_word and (compare_word.strip() != ''):
+        sizemod = 45
+        data = pd.merge(data,data2, on=[field, 'code'])
+        if type == 'scattergeo':
+            data = data[(data['WordsPerMillion_x'] != 0) & (data['WordsPerMillion_y'] != 0)]
+        maxval = data[['WordsPerMillion_x', 'WordsPerMillion_y']].max().max()
+        logcounts = sizemod*(data['WordsPerMillion_x'].apply(transform) - data['WordsPerMillion_y'].apply(transform))
+        text = ( data[field]
+                 + "<br> Words Per Million<br>    '{}': ".format(word)
+                 + data['WordsPerMillion_x'].round(1).astype(str)
+                 + "<br>    '{}': ".format(compare_word)
+                 + data['WordsPerMillion_y'].round(1).astype(str)
+                )
+        title = "\'%s\' vs. '%s' in the HathiTrust" % (word, compare_word)
+    else:
+        sizemod = 40
+        if type == 'scattergeo':
+            data = data[(data['WordsPerMillion'] != 0)]
+        counts = data['WordsPerMillion'].astype(int)
+        maxval = counts.max()
+        logcounts = sizemod*counts.apply(transform)
+        text = data[field] + '<br> Words Per Million:' + data['WordsPerMillion'].round(2).astype('str')
+        title = "\'%s\' in the HathiTrust" % word
+
+    plotdata = [ dict(
+            type=type,
+            hoverinfo = "location+text",
+            locationmode = locationmode,
+            locations = data['code'],
+            text = text,
+            marker = dict(
+                line = dict(width=0.5, color='rgb(40,40,40)'),
+                )
+            )]
+
+    if type == 'choropleth':
+        plotdata[0]['z'] = logcounts
+        #plotdata[0]['colorscale'] = scl,
+        plotdata[0]['autocolorscale'] = False
+        plotdata[0]['showscale'] = False
+        plotdata[0]['zauto'] = False
+        plotdata[0]['zmax'] = logcounts.abs().max()
+        plotdata[0]['zmin'] = -logcounts.abs().max()
+    elif type == 'scattergeo':
+        plotdata[0]['marker']['size'] = logcounts.abs()
+        plotdata[0]['marker']['color'] = logcounts
+        plotdata[0]['marker']['cauto'] = False
+        plotdata[0]['marker']['cmax'] = logcounts.abs().max()
+        plotdata[0]['marker']['cmin'] = -logcounts.abs().max()
+
+    layout = dict(
+            title = title,
+            margin=go.Margin(
+            l=10,r=10, b=10, t=50, pad=4
+        ),
+            geo = dict(
+                scope=scope,
+                projection=dict( type=projection ),
+                showframe = False,
+                showcoastlines = True,
+                showland = True,
+                landcolor = "rgb(229, 229, 229)",
+                countrycolor = "rgb(255, 255, 255)" ,
+                coastlinecolor = "rgb(255, 255, 255)",
+                showlakes = True,
+                lakecolor = 'rgb(255, 255, 255)')
+            )
+    return (plotdata, layout)
+
+@cached('map_figure')
+def map_figure(word, compare_word=None, type='scattergeo', scope='country'):
+    plotdata, layout = build_map(word, compare_word, type, scope)
+    return dict( data=plotdata, layout=layout )
+
+def format_heatmap_data(data, word, log, smoothing, soft_min_year, soft_max_year, facet_query=None):
+    facet = data.columns.values[0]
+    if log:
+        data.WordsPerMillion = data.WordsPerMillion.add(1).apply(np.log)
+    if (facet_query is not None) and (len(facet_query) != 0):
+       data = data[data[facet].isin(list(facet_query))]
+    years = pd.Series(range(soft_min_year,soft_max_year))
+    logging.debug(data)
+    logging.debug(data.date_year)
+    fullyears = pd.Series(range(data.date_year.min(),data.date_year.max()))
+    all_keys = pd.DataFrame(list(itertools.product(data[facet].unique(), fullyears)), columns=[facet, 'date_year'])
+
+    df2 = pd.merge(all_keys, data, how='left').fillna(0)
+    if smoothing:
+        df2.WordsPerMillion = df2.WordsPerMillion.rolling(5, min_periods=1).mean()
+    df2 = df2[(df2.date_year > soft_min_year) & (df2.date_year < soft_max_year)]
+
+    groups = df2.groupby(facet)
+    labels = []
+    counts = []
+    for g in groups:
+        labels.append(g[0])
+        counts.append(g[1]['WordsPerMillion'])
+
+    data = [go.Heatmap(z=counts,
+                   x=years,
+                   y=labels,
+                   showscale=False
+                  )
+       ]
+
+    layout = go.Layout(
+        title='"%s" by %s' % (word, pretty_facet(facet))
+    )
+
+    return (data, layout)
+
+def build_heatmap(word, facet, facet_query, years, facet_values):
+    # Display params
+    log = True
+    smoothing = 10
+    df = get_heatmap_values(word, facet, facet_values,
+                            hard_min_year=hard_min_year, hard_max_year=hard_max_year)
+    # Important, break reference to cached version
+    df = df.copy()
+    if not facet_query:
+        facet_query = []
+    if facet in labelled_facets:
+        labels = human_readable_labels[facet]
+        facet_query = [labels.get(entry, entry) for entry in facet_query]
+    return format_heatmap_data(df, word, log, smoothing, years[0], years[1], tuple(facet_query))
+
+# One per slider position and facet selection: kept in memory only, the data
+# behind them is on disk
+@cached('heatmap_figure', maxsize=64, persist=False)
+def heatmap_figure(word, facet, facet_query=(), years=(default_min_year, default_max_year)):
+    plotdata, layout = build_heatmap(word, facet, facet_query, years, max_facet_values)
+    return dict( data=plotdata, layout=layout )
+
+@cached('coarse_heatmap_figure', maxsize=64, persist=False)
+def coarse_heatmap_figure(word, facet, facet_query=(), years=(default_min_year, default_max_year)):
+    ''' Only the first few facet values, which Bookworm answers much faster '''
+    plotdata, layout = build_heatmap(word, facet, facet_query, years, coarse_facet_values)
+    return dict( data=plotdata, layout=layout )
+
+def bar_figure(group, trim_at=20, drop_radio='drop', counttype='TextCount'):
+    df = get_results(group, drop_radio=='drop')
+    logging.debug("Created DataFrame of results")
+    logging.debug(df)
+    try:
+        df = map_to_human_readable(df,group)
+        logging.debug("Ran map to human readable")
+    except Exception as e:
+        logging.error("ERROR occured!")
+        logging.error(e)
+    df = df.copy()
+    df_trimmed = df.head(trim_at)
+
+    data = [
+        go.Bar(
+            x=df_trimmed[group],
+            y=df_trimmed[counttype]
+        )
+    ]
+
+    return {
+            'data': data,
+            'layout': {
+                'yTitle': counttype,
+                'title': group.replace('_', ' ').title()
+            }
+        }
+
+def bar_table(group, drop_radio='drop'):
+    df = get_results(group, drop_radio=='drop')
+    logging.debug("Updated table")
+    logging.debug(df)
+    df = map_to_human_readable(df,group)
+    df = df.copy()
+    return FF.create_table(df)
+
+def date_distribution_figure(group, facet_value=None):
+    if facet_value:
+        map_to_ld = ld_values
+        if group in map_to_ld:
+            df = get_date_distribution(group, map_to_ld[group][facet_value])
+        else:
+            df = get_date_distribution(group, facet_value)
+        df = df.copy()
+        data = [
+            go.Scatter(
+                x=df['date_year'],
+                y=df['smoothed']
+            )
+        ]
+        return {
+            'data': data,
+            'layout': {
+                'height': 300,
+                'yaxis': {'range': [0, int(df.smoothed.max())+100]},
+                'title': 'Date Distribution for ' + facet_value.replace('_', ' ').title()
+            }
+        }
+    else:
+        data = [
+            go.Scatter(
+                x=list(range(1800, 2016)),
+                y=[0]*(2013-1800)
+            )
+        ]
+        return {
+            'data': data,
+            'layout': {
+                'height': 300,
+                'yaxis': {'range': [0, 100000]},
+                'title': 'Select a ' + group.replace('_', ' ') + ' to see date distribution'            }
+        }
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''
+Gunicorn settings: gunicorn -c gunicorn.conf.py app:server
+
+The app is loaded once in the master (preload_app) and its workers are forked
+from it, so the label tables loaded at import are shared copy-on-write. The
+memory-mapped data files (vocabulary, local shard, bar chart cube) are mapped
+in the master too, before forking, so the workers inherit the mappings rather
+than each opening its own. Objects that exist at fork time are frozen out of
+the garbage collector, which would otherwise touch every one of them and copy
+the pages.
+
+Each worker logs its resident memory, and restarts gracefully once it grows
+past WORKER_MAX_RSS_MB. Like the rest of the app, this logs to playground.log.
+'''
+import gc
+import logging
+import os
+import threading
+
+bind = os.environ.get('BIND', '0.0.0.0:10012')
+workers = int(os.environ.get('WORKERS', 4))
+# Callbacks mostly wait on Bookworm (see aioquery.py), so each worker serves
+# several at once from threads
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+timeout = 1200
+preload_app = True
+
+max_rss = int(os.environ.get('WORKER_MAX_RSS_MB', 3072))
+# Requests between memory checks
+rss_interval = int(os.environ.get('WORKER_RSS_INTERVAL', 50))
+
+_page_size = os.sysconf('SC_PAGE_SIZE')
+_requests = 0
+# Under gthread, post_request runs on the worker's request threads
+_requests_lock = threading.Lock()
+
+def rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * _page_size / 2**20
+
+def when_ready(server):
+    import bar_cube
+    import local_engine
+    import vocab
+    for data in (bar_cube, local_engine, vocab):
+        data.preload()
+    gc.collect()
+    gc.freeze()
+    logging.info("Froze %d objects before forking workers" % gc.get_freeze_count())
+
+def post_fork(server, worker):
+    logging.info("Worker %s started, %.0f MB resident" % (worker.pid, rss_mb()))
+
+def post_request(worker, req, environ, resp):
+    global _requests
+    with _requests_lock:
+        _requests += 1
+        requests = _requests
+    if requests % rss_interval:
+        return
+    rss = rss_mb()
+    logging.info("Worker %s: %.0f MB resident after %d requests" % (worker.pid, rss, requests))
+    if rss > max_rss:
+        logging.warning("Worker %s over %d MB, restarting" % (worker.pid, max_rss))
+        worker.alive = False
+
+def worker_exit(server, worker):
+    logging.info("Worker %s exiting, %.0f MB resident after %d requests" % (worker.pid, rss_mb(), _requests))
@@ -5,110 +5,54 @@ from dash.dependencies import  State, Input, Output
 import dash_bootstrap_components as dbc
 import plotly
 import plotly.graph_objs as go
-import pandas as pd
-import functools
 from common import app
 from common import graphconfig
-import bwypy
-import numpy as np
-import pandas as pd
-import itertools
 import json
-from tools import get_facet_group_options, pretty_facet, errorfig, logging_config, map_to_human_readable
+import time
+import uuid
+from figures import heatmap_figure, coarse_heatmap_figure, coarse_facet_values, hard_min_year, hard_max_year, default_min_year, default_max_year
+from queries import BackendBusy, BackendUnavailable, NoResults, UnknownWords, facet_opts, get_facet_value_options, get_example_books, split_words
+from tools import errorfig, busyfig, unavailablefig, noresultsfig, unknownfig, logging_config
+import patches
+import prefetch
+import progressive
+import vocab
 import logging
 from logging.config import dictConfig
 
 dictConfig(logging_config)
 logger = logging.getLogger()
 
-with open('config.json','r') as options_file:
-    bwypy_options = json.load(options_file)
-
-bwypy.set_options(database=bwypy_options['settings']['dbname'], endpoint=bwypy_options['settings']['endpoint'])
-bw_heatmap = bwypy.BWQuery(verify_fields=False,verify_cert=False)
-bw_heatmap.counttype = ['WordsPerMillion']
-bw_heatmap.json['words_collation'] = 'case_insensitive'
-
-bw_html = bwypy.BWQuery(verify_fields=False,verify_cert=False)
-bw_html.json['method'] = 'search_results'
-bw_html.json['words_collation'] = 'case_insensitive'
-
-hard_min_year = 1650
-hard_max_year = 2015
-default_min_year = 1900
-default_max_year = 2000
+keys = ['word', 'facet', 'min_year', 'max_year']
+defaults = ['computer', 'lc_classes', default_min_year, default_max_year]
 
 header = '''
 # Bookworm Heatmap
 See where a word occurs across facets in the 17 million volume [HathiTrust](https://www.hathitrust.org) collection.
 '''
 
-facet_opts = get_facet_group_options(bw_heatmap)
-
-@functools.lru_cache(maxsize=32)
-def get_heatmap_values(query, facet, max_facet_values=15, hard_min_year=1650, hard_max_year=2015):
-    words = [token.strip() for token in query.split(',')]
-    bw_heatmap.search_limits = { 'word': words, facet+'__id': { '$lt':max_facet_values+1 }, 
-                        'date_year': { '$lt': hard_max_year, '$gt': hard_min_year } }
-    bw_heatmap.groups = [facet, 'date_year']
-
-    # Get and format results
-    results = bw_heatmap.run()
-    df = results.frame(index=False, drop_unknowns=True)
-    df = map_to_human_readable(df,facet)
-    df.date_year = df.date_year.astype(float).astype(int)
-    df = df[df[facet] != '0']
-    return df
-
-def format_heatmap_data(data, word, log, smoothing, soft_min_year, soft_max_year, facet_query=None):
-    facet = data.columns.values[0]
-    if log:
-        data.WordsPerMillion = data.WordsPerMillion.add(1).apply(np.log)
-    if (facet_query is not None) and (len(facet_query) != 0):
-       data = data[data[facet].isin(list(facet_query))]
-    years = pd.Series(range(soft_min_year,soft_max_year))
-    logging.debug(data)
-    logging.debug(data.date_year)
-    fullyears = pd.Series(range(data.date_year.min(),data.date_year.max()))
-    all_keys = pd.DataFrame(list(itertools.product(data[facet].unique(), fullyears)), columns=[facet, 'date_year'])
+def serve_layout(params=None):
+    # Pre-load values from /q=word,facet,min_year,max_year URLs
+    q = dict(zip(keys,defaults))
+    if params is not None:
+        q.update(zip(keys,params))
+    years = [int(q['min_year']), int(q['max_year'])]
+    # The first heatmap and its facet values come with the layout (from the
+    # result cache, for the defaults), so landing on the page fires no server
+    # callbacks unless the heatmap is partial
+    fig, options, facet_query, shown, refine, request = landing_heatmap(q['word'], q['facet'], years)
 
-    df2 = pd.merge(all_keys, data, how='left').fillna(0)
-    if smoothing:
-        df2.WordsPerMillion = df2.WordsPerMillion.rolling(5, min_periods=1).mean()
-    df2 = df2[(df2.date_year > soft_min_year) & (df2.date_year < soft_max_year)]
-
-    groups = df2.groupby(facet)
-    labels = []
-    counts = []
-    for g in groups:
-        labels.append(g[0])
-        counts.append(g[1]['WordsPerMillion'])
-        
-    data = [go.Heatmap(z=counts,
-                   x=years,
-                   y=labels,
-                   showscale=False
-                  )
-       ]
-    
-    layout = go.Layout(
-        title='"%s" by %s' % (word, pretty_facet(facet))
-    )
-
-    return (data, layout)
-
-#df = get_heatmap_values('cookie', 'class', 15)
-#plotdata, layout = format_heatmap_data(df, 'cookie', True, 10, 1900, 2000)
-
-app.layout = html.Div([
+    return html.Div([
      html.Div([
         html.Div([
                 dcc.Markdown(header),
             
                 html.Div(
                     [html.Div(html.Label("Search For a Term: ", className='mb-2')),
-                     html.Div(dcc.Input(id='search-term', type='text', value='computer')),
-                     dcc.Input(id='search-term-hidden', type='hidden', value=json.dumps(dict(word='computer', compare=''))),
+                     html.Div(dcc.Input(id='search-term', type='text', value=q['word'], list='heatmap-search-suggestions')),
+                     html.Datalist(id='heatmap-search-suggestions'),
+                     # The word behind the current heatmap, for the example books
+                     dcc.Store(id='heatmap-query', data=dict(word=q['word'], compare='')),
                      html.Small("Combine search words with a comma. Only single word queries supported."),
                      ],
                 ),
@@ -122,12 +66,13 @@ app.layout = html.Div([
                 ),
                 html.Div(
                     [html.Label("Facet by:",className='mb-2'),
-                     dcc.Dropdown(id='group-dropdown', options=facet_opts, value='lc_classes', disabled=False)
+                     dcc.Dropdown(id='group-dropdown', options=facet_opts, value=q['facet'], disabled=False)
                     ]
                 ),
                 html.Div(
                     [dcc.Dropdown(
-                        options=[],
+                        options=options,
+                        value=facet_query,
                         multi=True,
                         id="facet-values",
                         disabled=False
@@ -142,12 +87,12 @@ app.layout = html.Div([
                             max=hard_max_year,
                             step=1,
                             marks=None,
-                            value=[default_min_year, default_max_year],
+                            value=years,
                             id='year-slider',
                             className='py-0 px-0',
                             disabled=False
                         ),
-                        html.Span(id='year-display')
+                        html.Span(id='year-display', children=year_range(years))
                     ],
                     className="form-group mb-3"
                 ),
@@ -155,7 +100,17 @@ app.layout = html.Div([
             ],
             className='col-md-3 px-3'),
         html.Div(
-            [dcc.Graph(id='main-heatmap-graph', animate=False, config=graphconfig)],
+            [dcc.Graph(id='main-heatmap-graph', figure=fig, animate=False, config=graphconfig),
+             # Set when the full heatmap is still to come, see progressive.py
+             dcc.Store(id='heatmap-refine'),
+             # The refine of a partial landing heatmap, started in the browser
+             dcc.Store(id='heatmap-landing-refine', data=refine),
+             # Token of the latest search, and the full heatmap once it is
+             # ready: a refine is only shown if no search was made since
+             dcc.Store(id='heatmap-request', data=request),
+             dcc.Store(id='heatmap-refined'),
+             # The full heatmap on screen, to send only what changes (see patches.py)
+             dcc.Store(id='heatmap-shown', data=shown)],
             className='col-md-9')
     ], className='row'),
       html.Div([
@@ -163,74 +118,61 @@ app.layout = html.Div([
             dcc.Markdown("""**Example Books**
             Choose a place on the heatmap to see matching books.
             """),
-            html.Div(id='heatmap-select-data'),
+            html.Div(id='heatmap-select-data', children=nothing_selected()),
         ], className='col-md-offset-4 col-md-8')
       ], className='row')
     ], className='container-fluid')
 
+app.layout = serve_layout
 
-@app.callback(
-    Output("facet-values", "options"),
-    Input('group-dropdown', 'value')
-)
-def set_facet_value_options(facet):
-    def trim(w, n=20):
-        if len(w)>n:
-            return w[:n]+'…'
-        else:
-            return w
-    logging.debug(bw_heatmap.field_values(facet, 40))
-    if facet in ['genres','languages','digitization_agent_code','format','htsource']:
-        with open('data/map_to_human_readable.json','r') as map_to_human_readable_file:
-            map_to_human_readable = json.load(map_to_human_readable_file)
-            return_values = []
-            for x in bw_heatmap.field_values(facet, 40):
-                if x.strip() != '':
-                    logging.info(x)
-                    logging.info(trim(x))
-                    logging.info(map_to_human_readable[facet])
-                    if x in map_to_human_readable[facet]:
-                        logging.info(map_to_human_readable[facet][x])
-                    else:
-                        logging.info(trim(x))
-#                    label = map_to_human_readable[facet][trim(x)]
-            return [{'label': trim(map_to_human_readable[facet][x]), 'value': x} if x in map_to_human_readable[facet] else {'label': trim(x), 'value': x} for x in bw_heatmap.field_values(facet, 40) if x.strip() != '']
-    else:
-        return [{'label': trim(x), 'value': x} for x in bw_heatmap.field_values(facet, 40) if x.strip() != '']
+def landing_heatmap(word, facet, years):
+    ''' The heatmap to embed in the layout, its facet value options and selection,
+    its *-shown and *-refine data, and the request token '''
+    options, facet_query = [], []
+    try:
+        options = get_facet_value_options(facet)
+        facet_query = [option['value'] for option in options[:10]]
+        args = (word, facet, tuple(facet_query), tuple(years))
+        fig, pending = render_heatmap(args)
+    except Exception as error:
+        fig = search_error(error, word_query=dict(word=word, compare=''), facet=facet, facet_query=facet_query, years=years)
+        return fig, options, facet_query, None, None, None
+    if pending:
+        request = uuid.uuid4().hex
+        return fig, options, facet_query, None, dict(args=args, requested=time.time(), request=request), request
+    return fig, options, facet_query, patches.shown(args, fig), None, None
+
+def render_heatmap(args):
+    ''' progressive.render() for heatmap_figure(*args) '''
+    return progressive.render(heatmap_figure, args, coarse_heatmap_figure, args,
+                              note='(top %d, loading the rest…)' % coarse_facet_values)
+
+def nothing_selected():
+    return html.Ul(html.Li(html.Em("Nothing selected")))
 
-@app.callback(
-    Output("facet-values", "value"),
-    Input("facet-values", "options")
-)
-def set_facet_value_defaults(options):
-    return [option['value'] for option in options[:10]]
-    
 @app.callback(
     Output('heatmap-select-data', 'children'),
     Input('main-heatmap-graph', 'clickData'),
-    State('search-term-hidden', 'value'),
-    State('group-dropdown', 'value')
+    State('heatmap-query', 'data'),
+    State('group-dropdown', 'value'),
+    prevent_initial_call=True
 )
 def display_click_data(clickData, word_query, facet):
     import re
-    word_query=json.loads(word_query)
     word = word_query['word']
     compare_word = word_query['compare']
     try:
         facet_value_select = clickData['points'][0]['y']
         year_select = int(clickData['points'][0]['x'])
     except:
-        return html.Ul(html.Li(html.Em("Nothing selected")))
+        return nothing_selected()
     if compare_word and compare_word.strip() != '':
         word = word + "," + compare_word
-    q = word.split(",")
-        
-    bw_html.search_limits = { facet: [facet_value_select], 'date_year':year_select, 'word': q }
-    results = bw_html.run()
-    
+    q = split_words(word)
+
     # Format results
     links = []
-    for result in results.json():
+    for result in get_example_books({ facet: [facet_value_select], 'date_year':year_select, 'word': q }):
         try:
             groups = re.search("href=(.*)><em>(.*?)</em> \((.*?)\)", result).groups()
             link = html.Li(html.A(href=groups[0], target='_blank', children=["%s (%s)" % (groups[1], groups[2])]))
@@ -241,10 +183,27 @@ def display_click_data(clickData, word_query, facet):
     return html.Ul(links)
 
 @app.callback(
+    Output('heatmap-search-suggestions', 'children'),
+    Input('search-term', 'value'),
+    prevent_initial_call=True
+)
+def suggest_search_terms(word):
+    return [html.Option(value=completion) for completion in vocab.complete(word)]
+
+# Runs in the browser, so moving the slider costs only the heatmap's own callback
+app.clientside_callback(
+    '''
+    function(years) {
+        return years[0] + ' - ' + years[1];
+    }
+    ''',
     Output('year-display', 'children'),
-    Input('year-slider', "value")
+    Input('year-slider', "value"),
+    prevent_initial_call=True
 )
-def display_year(years):
+
+def year_range(years):
+    ''' Same text as the clientside callback above, for the layout '''
     return "%d - %d" % tuple(years)
 
 #@app.callback(
@@ -264,56 +223,127 @@ def display_year(years):
 #    else:
 #        return True, True, True, True, [dbc.Spinner(size='sm',show_initially=True),' Querying...']
 
+# A single callback for every control, so that one change is one round-trip.
+# Changing the facet also fills in its value options and the first ten as the
+# default selection, which used to take two more chained callbacks. The first
+# heatmap is part of the layout, see landing_heatmap().
 @app.callback(
-    Output('search-term-hidden', 'value'),
+    Output('main-heatmap-graph', 'figure'),
+    Output("facet-values", "options"),
+    Output("facet-values", "value"),
+    Output('heatmap-query', 'data'),
+    Output('heatmap-refine', 'data'),
+    Output('heatmap-shown', 'data'),
+    Output('heatmap-request', 'data'),
     Input('word_search_button', 'n_clicks'),
+    Input('group-dropdown', 'value'),
+    Input("facet-values", "value"),
+    Input('year-slider', "value"),
     State('search-term', 'value'),
-    State('compare-term', 'value')
+    State('compare-term', 'value'),
+    State('heatmap-query', 'data'),
+    State('heatmap-shown', 'data'),
+    prevent_initial_call=True
 )
-def update_hidden_search_term(n_clicks, word, compare):
-    return json.dumps(dict(word=word, compare=compare))
+def heatmap_search(n_clicks, facet, facet_query, years, word, compare, word_query, shown):
+    triggered = dash.ctx.triggered_prop_ids
+    # Other controls keep the word that was last searched
+    if word_query is None or 'word_search_button.n_clicks' in triggered:
+        word_query = dict(word=word, compare=compare)
+    options = values = refine = dash.no_update
+    new_shown = None
+    request = uuid.uuid4().hex
+    try:
+        if 'group-dropdown.value' in triggered:
+            options = get_facet_value_options(facet)
+            facet_query = values = [option['value'] for option in options[:10]]
+        args = (word_query['word'], facet, tuple(facet_query or []), tuple(years))
+        fig, pending = render_heatmap(args)
+        if pending:
+            refine = dict(args=args, requested=time.time(), request=request)
+        else:
+            new_shown = patches.shown(args, fig)
+            fig = patches.replace(heatmap_figure, shown, fig)
+    except Exception as error:
+        fig = search_error(error, word_query=word_query, facet=facet, facet_query=facet_query, years=years)
+    if new_shown is not None:
+        # Warm up what the user is likely to look at next
+        prefetch.heatmap_siblings(*args)
+    return fig, options, values, word_query, refine, new_shown, request
 
 @app.callback(
-    Output('main-heatmap-graph', 'figure'),
-    Input('search-term-hidden', 'value'),
-    Input("facet-values", "value"),
-    Input('year-slider', "value"),
-    State('group-dropdown', 'value')
+    Output('heatmap-refined', 'data'),
+    Input('heatmap-refine', 'data'),
+    State('heatmap-request', 'data'),
+    prevent_initial_call=True
 )
-#def heatmap_search(word_query, facet, facet_query, years):
-def heatmap_search(word_query, facet_query, years, facet):
+def heatmap_refine(refine, request):
+    # Another search was made before this refine even started
+    if refine['request'] != request:
+        return dash.no_update
+    args = figure_args(refine['args'])
     try:
-        word_query=json.loads(word_query)
-        word = word_query['word']
-        compare_word = word_query['compare']
-        max_facet_values = 30
+        fig = progressive.refine(heatmap_figure, args)
+    except Exception as error:
+        word, facet, facet_query, years = args
+        fig = search_error(error, word=word, facet=facet, facet_query=facet_query, years=years)
+        return dict(request=refine['request'], figure=fig, shown=None)
+    # Past the deadline, leave the coarse heatmap on screen
+    if fig is None:
+        return dash.no_update
+    prefetch.heatmap_siblings(*args)
+    return dict(request=refine['request'], figure=fig, shown=patches.shown(args, fig))
 
-        # Display params
-        log = True
-        smoothing = 10
-        df = get_heatmap_values(word, facet, max_facet_values,
-                                hard_min_year=hard_min_year, hard_max_year=hard_max_year)
-        # Important, break reference to cached version
-        df = df.copy()
-        if not facet_query:
-            facet_query = []
-        if facet in ['genres','languages','digitization_agent_code','format','htsource']:
-            with open('data/map_to_human_readable.json','r') as map_to_human_readable_file:
-                map_to_human_readable = json.load(map_to_human_readable_file)
-                new_facet_query = []
-                for entry in facet_query:
-                    if entry in map_to_human_readable[facet]:
-                        new_facet_query.append(map_to_human_readable[facet][entry])
-                    else:
-                        new_facet_query.append(entry)
-                facet_query = new_facet_query
-        plotdata, layout = format_heatmap_data(df, word, log, smoothing, years[0], years[1], tuple(facet_query))
-        fig = dict( data=plotdata, layout=layout )
-    except:
-        logging.exception(json.dumps(dict(page='heatmap', word_query=word_query, facet=facet,
-                                      facet_query=facet_query, years=years)))
-        fig = errorfig()
-    return fig
+# Only a partial landing heatmap starts a refine, so landing on a complete one
+# fires no server callback
+app.clientside_callback(
+    '''
+    function(refine) {
+        return refine || window.dash_clientside.no_update;
+    }
+    ''',
+    Output('heatmap-refine', 'data', allow_duplicate=True),
+    Input('heatmap-landing-refine', 'data'),
+    prevent_initial_call='initial_duplicate'
+)
+
+# Checked in the browser, where the latest search's token is known by the time
+# the full heatmap arrives
+app.clientside_callback(
+    '''
+    function(refined, request) {
+        if (!refined || refined.request !== request) {
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+        }
+        return [refined.figure, refined.shown];
+    }
+    ''',
+    Output('main-heatmap-graph', 'figure', allow_duplicate=True),
+    Output('heatmap-shown', 'data', allow_duplicate=True),
+    Input('heatmap-refined', 'data'),
+    State('heatmap-request', 'data'),
+    prevent_initial_call=True
+)
+
+def figure_args(stored):
+    ''' heatmap_figure() arguments back from their JSON form in a store '''
+    if stored is None:
+        return None
+    word, facet, facet_query, years = stored
+    return (word, facet, tuple(facet_query), tuple(years))
+
+def search_error(error, **context):
+    ''' Figure to show in place of a failed heatmap '''
+    if isinstance(error, BackendBusy):
+        return busyfig()
+    if isinstance(error, BackendUnavailable):
+        return unavailablefig()
+    if isinstance(error, UnknownWords):
+        return unknownfig(error.suggestions)
+    if isinstance(error, NoResults):
+        return noresultsfig(error.args[0])
+    logging.exception(json.dumps(dict(page='heatmap', **context)))
+    return errorfig()
 
 if __name__ == '__main__':
     app.config.supress_callback_exceptions = True
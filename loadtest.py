@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+'''
+End-to-end load test: runs the real app:server under gunicorn, with the
+production settings from gunicorn.conf.py, against a local fake Bookworm (fake_bookworm.py) and drives it with simulated users that click
+through the map, heatmap and bar chart pages the way the browser would, by
+POSTing Dash callback requests.
+
+    python loadtest.py --workers 4 --users 40 --duration 120 --latency 0.5
+    python loadtest.py --worker-class sync --threads 1 --error-rate 0.05
+
+Reports throughput, p50/p95/p99 latency (overall and per callback) and the
+peak RSS of every gunicorn worker.
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+words = ['color', 'colour', 'computer', 'war', 'peace', 'science', 'railroad', 'telegraph', 'radio',
+         'electricity', 'liberty', 'slavery', 'cholera', 'vaccine', 'atom', 'television', 'automobile',
+         'democracy', 'empire', 'steam', 'whale', 'cotton', 'tobacco', 'internet', 'photograph']
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+def rss_mb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    return None
+
+def children(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as children_file:
+            return [int(child) for child in children_file.read().split()]
+    except OSError:
+        return []
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.rss = {}
+
+    def record(self, label, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(label, []).append(seconds)
+            if not ok:
+                self.errors[label] = self.errors.get(label, 0) + 1
+
+    def sample_rss(self, master_pid):
+        for pid in children(master_pid):
+            rss = rss_mb(pid)
+            if rss is not None:
+                with self.lock:
+                    self.rss[pid] = max(self.rss.get(pid, 0), rss)
+
+def split_output(output):
+    ''' 'a.b' or '..a.b...c.d..' to a list of (id, property); duplicate outputs carry an '@hash' suffix '''
+    parts = output.strip('.').split('...') if output.startswith('..') else [output]
+    return [tuple(part.split('@')[0].rsplit('.', 1)) for part in parts]
+
+class DashUser:
+    ''' Just enough of the Dash renderer to replay callback chains '''
+    def __init__(self, base_url, dependencies, stats, rng):
+        self.base_url = base_url
+        # Clientside callbacks run in the browser and cost the server nothing
+        self.dependencies = [dependency for dependency in dependencies if not dependency.get('clientside_function')]
+        self.stats = stats
+        self.rng = rng
+        self.session = requests.Session()
+        self.props = {}
+
+    def collect(self, component):
+        if isinstance(component, list):
+            for child in component:
+                self.collect(child)
+        elif isinstance(component, dict) and 'props' in component:
+            props = component['props']
+            if 'id' in props:
+                for name, value in props.items():
+                    self.props[(props['id'], name)] = value
+            self.collect(props.get('children'))
+
+    def present(self, dependency):
+        return all((output_id, 'id') in self.props for output_id, _ in split_output(dependency['output']))
+
+    def fire(self, dependency, changed):
+        outputs = split_output(dependency['output'])
+        payload = {
+            'output': dependency['output'],
+            'outputs': [dict(id=i, property=p) for i, p in outputs] if len(outputs) > 1 else dict(id=outputs[0][0], property=outputs[0][1]),
+            'inputs': [dict(item, value=self.props.get((item['id'], item['property']))) for item in dependency['inputs']],
+            'state': [dict(item, value=self.props.get((item['id'], item['property']))) for item in dependency['state']],
+            'changedPropIds': ['%s.%s' % prop for prop in changed],
+        }
+        label = '+'.join('%s.%s' % output for output in outputs)
+        start = time.time()
+        try:
+            response = self.session.post(self.base_url + '_dash-update-component', json=payload, timeout=1300)
+            ok = response.status_code in (200, 204)
+        except requests.RequestException:
+            response, ok = None, False
+        self.stats.record(label, time.time() - start, ok)
+        if not ok or response.status_code == 204:
+            return []
+
+        updated = []
+        for component_id, props in response.json().get('response', {}).items():
+            for name, value in props.items():
+                # Partial updates are not applied, the harness never reads figures back
+                if not (isinstance(value, dict) and '__dash_patch_update' in value):
+                    self.props[(component_id, name)] = value
+                updated.append((component_id, name))
+                if name == 'children':
+                    self.collect(value)
+        return updated
+
+    def changed(self, props, source=None):
+        ''' Fire every callback triggered by `props`, then everything those trigger '''
+        pending = [(prop, source) for prop in props]
+        while pending:
+            updates = pending
+            pending = []
+            for dependency in self.dependencies:
+                # Like the renderer, a callback is not re-triggered by its own outputs
+                triggered = set(prop for prop, source in updates if source is not dependency)
+                inputs = set((item['id'], item['property']) for item in dependency['inputs'])
+                if inputs & triggered and self.present(dependency):
+                    pending += [(prop, dependency) for prop in self.fire(dependency, inputs & triggered)]
+
+    def load(self, pathname):
+        self.props = {('url', 'pathname'): pathname, ('url', 'id'): 'url'}
+        for dependency in self.dependencies:
+            if dependency['output'] == 'page-content.children':
+                self.fire(dependency, [('url', 'pathname')])
+        # Initial call of every callback on the new page, as the renderer does
+        initial = [dependency for dependency in self.dependencies
+                   if self.present(dependency) and not dependency.get('prevent_initial_call')
+                   and dependency['output'] != 'page-content.children']
+        for dependency in initial:
+            # The renderer sends no changedPropIds for initial calls
+            self.changed(self.fire(dependency, []), dependency)
+        # A partial landing figure starts its refine from a clientside callback
+        for page in ('map', 'heatmap'):
+            refine = self.props.get(('%s-landing-refine' % page, 'data'))
+            if refine:
+                self.set('%s-refine' % page, 'data', refine)
+
+    def set(self, component_id, name, value):
+        self.props[(component_id, name)] = value
+        self.changed([(component_id, name)])
+
+    def click(self, button_id):
+        clicks = (self.props.get((button_id, 'n_clicks')) or 0) + 1
+        self.props[(button_id, 'n_clicks')] = clicks
+        self.changed([(button_id, 'n_clicks')])
+
+    def map_session(self, actions):
+        self.load('/app/')
+        for _ in range(actions):
+            action = self.rng.random()
+            if action < 0.4:
+                self.props[('search-term', 'value')] = self.rng.choice(words)
+                self.props[('compare-term', 'value')] = self.rng.choice(['', self.rng.choice(words)])
+                self.click('words_search_button')
+            elif action < 0.7:
+                self.set('map_scope', 'value', self.rng.choice(['country', 'state']))
+            else:
+                self.set('map_type', 'value', self.rng.choice(['scattergeo', 'choropleth']))
+            yield
+
+    def heatmap_session(self, actions):
+        self.load('/app/heatmap')
+        for _ in range(actions):
+            action = self.rng.random()
+            if action < 0.3:
+                self.props[('search-term', 'value')] = self.rng.choice(words)
+                self.click('word_search_button')
+            elif action < 0.8:
+                # A drag ends in a handful of slider updates
+                low, high = self.props.get(('year-slider', 'value')) or [1900, 2000]
+                for _ in range(self.rng.randint(1, 4)):
+                    low = min(max(1650, low + self.rng.randint(-20, 20)), 2000)
+                    high = max(min(2015, high + self.rng.randint(-20, 20)), low + 5)
+                    self.set('year-slider', 'value', [low, high])
+            else:
+                self.set('group-dropdown', 'value', self.rng.choice(['lc_classes', 'languages', 'genres', 'publication_country']))
+            yield
+
+    def bar_session(self, actions):
+        self.load('/app/bar')
+        for _ in range(actions):
+            if self.rng.random() < 0.2:
+                self.set('bar-group-dropdown', 'value', self.rng.choice(['languages', 'lc_classes', 'genres', 'format']))
+            else:
+                figure = self.props.get(('bar-chart-main-graph', 'figure')) or {}
+                labels = (figure.get('data') or [{}])[0].get('x') or ['English']
+                self.set('bar-chart-main-graph', 'hoverData', {'points': [{'x': self.rng.choice(labels)}]})
+            yield
+
+def simulate(base_url, dependencies, stats, deadline, think, seed):
+    rng = random.Random(seed)
+    while time.time() < deadline:
+        user = DashUser(base_url, dependencies, stats, rng)
+        session = rng.choices([user.map_session, user.heatmap_session, user.bar_session], weights=[5, 4, 1])[0]
+        for _ in session(rng.randint(3, 10)):
+            if time.time() >= deadline:
+                return
+            time.sleep(rng.expovariate(1.0 / think) if think else 0)
+
+def wait_for(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("%s did not come up within %ds" % (url, timeout))
+
+def prepare(run_dir, args):
+    ''' A copy of the app directory whose config.json points at the fake Bookworm '''
+    for name in os.listdir(here):
+        if name not in ('config.json', 'cache', '.git'):
+            os.symlink(os.path.join(here, name), os.path.join(run_dir, name))
+    settings = {}
+    if os.path.exists(os.path.join(here, 'config.json')):
+        with open(os.path.join(here, 'config.json')) as config_file:
+            settings = json.load(config_file).get('settings', {})
+    settings.update(dbname='loadtest', endpoint='http://127.0.0.1:%d/' % args.bookworm_port,
+                    linechart=settings.get('linechart', '#'),
+                    cache_dir=args.cache_dir or os.path.join(run_dir, 'cache'))
+    with open(os.path.join(run_dir, 'config.json'), 'w') as config_file:
+        json.dump({'settings': settings}, config_file)
+
+def report(stats, elapsed):
+    total = sum(len(values) for values in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    everything = [value for values in stats.latencies.values() for value in values]
+    print("\n%d requests in %.1fs: %.2f req/s, %d errors" % (total, elapsed, total / elapsed, errors))
+    row = "%-60s %7s %7s %8s %8s %8s"
+    print(row % ('callback', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for label, values in sorted(stats.latencies.items()) + [('ALL', everything)]:
+        print(row % (label[:60], len(values), stats.errors.get(label, errors if label == 'ALL' else 0),
+                     '%.0f' % (1000 * percentile(values, 50)), '%.0f' % (1000 * percentile(values, 95)),
+                     '%.0f' % (1000 * percentile(values, 99))))
+    print("\nPeak worker RSS:")
+    for pid, rss in sorted(stats.rss.items()):
+        print("  worker %d: %.1f MB" % (pid, rss))
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the app against a fake Bookworm.')
+    parser.add_argument('--users', type=int, default=20, help='concurrent simulated users (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run (default: %(default)s)')
+    parser.add_argument('--think', type=float, default=1.0, help='mean pause between user actions in seconds (default: %(default)s)')
+    parser.add_argument('--workers', type=int, help='gunicorn workers (default: as in gunicorn.conf.py)')
+    parser.add_argument('--worker-class', help='gunicorn worker class (default: as in gunicorn.conf.py)')
+    parser.add_argument('--threads', type=int, help='gunicorn threads per worker (default: as in gunicorn.conf.py)')
+    parser.add_argument('--gunicorn-arg', action='append', default=[], help='extra argument passed to gunicorn, repeatable')
+    parser.add_argument('--port', type=int, default=10013)
+    parser.add_argument('--bookworm-port', type=int, default=10014)
+    parser.add_argument('--latency', type=float, default=0.2, help='fake Bookworm mean latency in seconds (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.1, help='fake Bookworm latency std. deviation (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of fake Bookworm requests that fail (default: %(default)s)')
+    parser.add_argument('--cache-dir', help='result cache to use; defaults to an empty one per run')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run_dir = tempfile.mkdtemp(prefix='bookworm-loadtest-')
+    processes = []
+    try:
+        prepare(run_dir, args)
+        processes.append(subprocess.Popen(
+            [sys.executable, 'fake_bookworm.py', '--port', str(args.bookworm_port), '--latency', str(args.latency),
+             '--jitter', str(args.jitter), '--error-rate', str(args.error_rate)], cwd=run_dir))
+        # Command line options override the config file
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', '127.0.0.1:%d' % args.port]
+        for option, value in [('-w', args.workers), ('-k', args.worker_class), ('--threads', args.threads)]:
+            if value is not None:
+                command += [option, str(value)]
+        gunicorn = subprocess.Popen(command + args.gunicorn_arg + ['app:server'], cwd=run_dir)
+        processes.append(gunicorn)
+
+        base_url = 'http://127.0.0.1:%d/app/' % args.port
+        wait_for(base_url, 120)
+        dependencies = requests.get(base_url + '_dash-dependencies').json()
+
+        stats = Stats()
+        start = time.time()
+        deadline = start + args.duration
+        users = [threading.Thread(target=simulate, args=(base_url, dependencies, stats, deadline, args.think, args.seed + n))
+                 for n in range(args.users)]
+        for user in users:
+            user.start()
+        while any(user.is_alive() for user in users):
+            stats.sample_rss(gunicorn.pid)
+            time.sleep(1)
+        report(stats, time.time() - start)
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+        for process in processes:
+            process.wait()
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+'''
+Embedded query engine for the word queries behind the map and heatmap pages.
+
+The per-country, per-state and facet x date_year WordsPerMillion results of the
+most frequent words are materialized into a local Arrow shard. A query that is
+identical to one of the materialized queries apart from its word list, and
+only asks for words in the shard, is answered from the shard without a
+Bookworm round-trip. WordsPerMillion is additive over the words of a word list
+(the denominator is the group's word total), so word lists are answered by
+summing the single-word results. Everything else goes to Bookworm.
+
+Refresh the shard after every index rebuild with:
+
+    python local_engine.py [--top 2000] [--facets lc_classes] [--output data/word_shard.arrow]
+
+Words are the most frequent ones in the vocabulary index (see vocab.py), or
+read from --words. Running workers pick up a new shard on their next query.
+'''
+import argparse
+import copy
+import functools
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+SHARD_PATH = 'data/word_shard.arrow'
+
+schema = pa.schema([
+    ('group1', pa.string()),
+    # null for single-group queries
+    ('group2', pa.string()),
+    ('WordsPerMillion', pa.float64()),
+])
+
+def _template(query):
+    ''' The query without its word list, as a canonical string '''
+    query = copy.deepcopy(query)
+    query.get('search_limits', {}).pop('word', None)
+    return json.dumps(query, sort_keys=True)
+
+def _words(query):
+    words = query.get('search_limits', {}).get('word')
+    if not isinstance(words, list):
+        return None
+    # Queries use case insensitive collation, and a repeated word is only counted once
+    return list(dict.fromkeys(word.strip().lower() for word in words))
+
+def _rows(df):
+    rows = pd.DataFrame({ 'group1': df.iloc[:, 0].astype(str),
+                          'group2': df.iloc[:, 1].astype(str) if df.shape[1] > 2 else None,
+                          'WordsPerMillion': df.iloc[:, -1].astype(float) })
+    return pa.RecordBatch.from_pandas(rows, schema=schema, preserve_index=False)
+
+def kinds(facets):
+    ''' Name -> query builder for every materialized query '''
+    import figures
+    import queries
+
+    builders = { 'country': queries.country_query, 'state': queries.us_state_query }
+    for facet in facets:
+        builders['heatmap:' + facet] = functools.partial(queries.heatmap_query, facet=facet,
+                                                         max_facet_values=figures.max_facet_values,
+                                                         hard_min_year=figures.hard_min_year,
+                                                         hard_max_year=figures.hard_max_year)
+    return builders
+
+def materialize(words, facets, path=SHARD_PATH):
+    import queries
+
+    templates = {}
+    index = {}
+    batches = []
+    offset = 0
+    for kind, build_query in kinds(facets).items():
+        logging.info("Materializing %s for %d words" % (kind, len(words)))
+        columns = None
+        index[kind] = {}
+        for word in words:
+            query = build_query([word])
+            templates[_template(query.json)] = kind
+            try:
+                df = queries.run(query).frame(index=False, drop_unknowns=True)
+            except Exception:
+                # Left to Bookworm at query time
+                logging.exception("Could not materialize %s for '%s'" % (kind, word))
+                continue
+            columns = list(df.columns)
+            batch = _rows(df)
+            index[kind][word] = [offset, batch.num_rows]
+            batches.append(batch)
+            offset += batch.num_rows
+        index[kind] = dict(columns=columns, words=index[kind])
+
+    # Write next to the target and swap, so running workers never see a partial file
+    metadata = { 'templates': json.dumps(templates), 'index': json.dumps(index) }
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema.with_metadata(metadata)) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    os.replace(tmp_path, path)
+    return offset
+
+def available(path=SHARD_PATH):
+    return os.path.exists(path)
+
+@functools.lru_cache(maxsize=1)
+def load_shard(path=SHARD_PATH, mtime=None):
+    ''' Memory-map the shard. mtime is only part of the cache key, so a rebuilt shard is reloaded. '''
+    source = pa.memory_map(path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+    templates = json.loads(table.schema.metadata[b'templates'])
+    index = json.loads(table.schema.metadata[b'index'])
+    return table, templates, index
+
+def preload(path=SHARD_PATH):
+    ''' Map the shard now, e.g. in the gunicorn master so that workers inherit it '''
+    if available(path):
+        load_shard(path, os.stat(path).st_mtime)
+
+def answer(query, path=SHARD_PATH):
+    ''' results.frame(index=False, drop_unknowns=True) for the query, or None if the shard can't answer it '''
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+    table, templates, index = load_shard(path, mtime)
+
+    kind = templates.get(_template(query))
+    words = _words(query)
+    if kind is None or not words or index[kind]['columns'] is None:
+        return None
+    slices = index[kind]['words']
+    if any(word not in slices for word in words):
+        return None
+
+    columns = index[kind]['columns']
+    groups = columns[:-1]
+    frames = [table.slice(*slices[word]).to_pandas() for word in words]
+    df = pd.concat(frames, ignore_index=True)
+    df.columns = ['group1', 'group2', columns[-1]]
+    if len(groups) == 1:
+        df = df.drop(columns=['group2'])
+    df.columns = columns
+    if len(words) > 1:
+        df = df.groupby(groups, sort=False)[columns[-1]].sum().reset_index()
+    return df
+
+def top_words(n):
+    import vocab
+    return vocab.most_frequent(n)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Materialize the local word shard from Bookworm.')
+    parser.add_argument('--top', type=int, default=2000, help='number of most frequent words from the vocabulary index (default: %(default)s)')
+    parser.add_argument('--words', help='file with one word per line, instead of the vocabulary index')
+    parser.add_argument('--facets', default='lc_classes', help='comma separated heatmap facets (default: %(default)s)')
+    parser.add_argument('--output', default=SHARD_PATH, help='Arrow file to write (default: %(default)s)')
+    args = parser.parse_args()
+    if args.words:
+        with open(args.words, 'r') as words_file:
+            words = [line.strip().lower() for line in words_file if line.strip()]
+    else:
+        words = top_words(args.top)
+    rows = materialize(words, [facet for facet in args.facets.split(',') if facet], args.output)
+    print("Wrote %d rows for %d words to %s" % (rows, len(words), args.output))
@@ -5,39 +5,26 @@ from dash.dependencies import  State, Input, Output
 import dash_bootstrap_components as dbc
 import plotly
 import plotly.graph_objs as go
-import pandas as pd
-import functools
 from common import app
 from common import graphconfig
-import bwypy
 import json
-from tools import errorfig, logging_config
+import time
+import uuid
+from figures import map_defaults, map_figure
+from queries import BackendBusy, BackendUnavailable, NoResults, UnknownWords, get_example_books, split_words
+from tools import errorfig, busyfig, unavailablefig, noresultsfig, unknownfig, logging_config
+import patches
+import prefetch
+import progressive
+import vocab
 import logging
 from logging.config import dictConfig
 
 dictConfig(logging_config)
 logger = logging.getLogger()
 
-with open('config.json','r') as options_file:
-    bwypy_options = json.load(options_file)
-
-bwypy.set_options(database=bwypy_options['settings']['dbname'], endpoint=bwypy_options['settings']['endpoint'])
-bw_map = bwypy.BWQuery(verify_fields=False,verify_cert=False)
-bw_map.counttype = ['WordsPerMillion']
-bw_map.json['words_collation'] = 'case_insensitive'
-
-bw_html = bwypy.BWQuery(verify_fields=False,verify_cert=False)
-bw_html.json['method'] = 'search_results'
-bw_html.json['words_collation'] = 'case_insensitive'
-
 keys = ['word', 'compare_word', 'type', 'scope']
-defaults = ['color', 'colour', 'scattergeo', 'country']
-# Future support for pre-load param insertion
-params = None
-if params is not None:
-    q = dict(zip(keys,params))
-else:
-    q = dict(zip(keys,defaults))
+defaults = map_defaults
 
 header = '''
 # Bookworm Map
@@ -46,135 +33,28 @@ See where a word occurs in the 17 million volume [HathiTrust](https://www.hathit
 Locations correspond to the places that volumes were published in.
 '''
 
-country_codes = pd.read_csv('data/country_codes.csv')
-state_codes = pd.read_csv('data/state_codes_us.csv')
-
-@functools.lru_cache(maxsize=32)
-def get_word_by_us_state(word):
-    words = [token.strip() for token in word.split(',')]
-    bw_map.search_limits = { 'word':word.split(','), 'publication_country': 'United States' }
-    bw_map.groups = ['*publication_country', 'publication_state']
-    results = bw_map.run()
-    df = results.frame(index=False, drop_unknowns=True)
-    data = pd.merge(df, state_codes)
-    return data
-
-@functools.lru_cache(maxsize=32)
-def get_word_by_country(word):
-    words = [token.strip() for token in word.split(',')]
-    bw_map.search_limits = { 'word':words }
-    bw_map.groups = ['publication_country']
-    results = bw_map.run()
-    df = results.frame(index=False, drop_unknowns=True)
-    data = pd.merge(df, country_codes)
-    return data
-
-def build_map(word, compare_word=None, type='scattergeo', scope='country'):
-    import pandas as pd
-    import numpy as np
-
-    transform = lambda x: np.log(1+x/maxval)
-
-    if scope == 'country':
-        data = get_word_by_country(word).copy()
-        if compare_word:
-            data2 = get_word_by_country(compare_word).copy()
-        field = 'publication_country'
-        scope = 'world'
-        projection = 'Mercator'
-        locationmode = 'ISO-3'
-    elif scope == 'state':
-        data = get_word_by_us_state(word).copy()
-        if compare_word:
-            data2 = get_word_by_us_state(compare_word).copy()
-        field = 'publication_state'
-        scope = 'usa'
-        projection = 'albers usa'
-        locationmode = 'USA-states'
-    
-    if compare_word and (compare_word.strip() != ''):
-        sizemod = 45
-        data = pd.merge(data,data2, on=[field, 'code'])
-        if type == 'scattergeo':
-            data = data[(data['WordsPerMillion_x'] != 0) & (data['WordsPerMillion_y'] != 0)]
-        maxval = data[['WordsPerMillion_x', 'WordsPerMillion_y']].max().max()
-        logcounts = sizemod*(data['WordsPerMillion_x'].apply(transform) - data['WordsPerMillion_y'].apply(transform))
-        text = ( data[field]
-                 + "<br> Words Per Million<br>    '{}': ".format(word) 
-                 + data['WordsPerMillion_x'].round(1).astype(str) 
-                 + "<br>    '{}': ".format(compare_word) 
-                 + data['WordsPerMillion_y'].round(1).astype(str)
-                )
-        title = "\'%s\' vs. '%s' in the HathiTrust" % (word, compare_word)
-    else:
-        sizemod = 40
-        if type == 'scattergeo':
-            data = data[(data['WordsPerMillion'] != 0)]
-        counts = data['WordsPerMillion'].astype(int)
-        maxval = counts.max()
-        logcounts = sizemod*counts.apply(transform)
-        text = data[field] + '<br> Words Per Million:' + data['WordsPerMillion'].round(2).astype('str')
-        title = "\'%s\' in the HathiTrust" % word
-        
-    if compare_word:
-        counts2 = data2['WordsPerMillion'].astype(int)
-   
-    plotdata = [ dict(
-            type=type,
-            hoverinfo = "location+text",
-            locationmode = locationmode,
-            locations = data['code'],
-            text = text,
-            marker = dict(
-                line = dict(width=0.5, color='rgb(40,40,40)'),
-                )
-            )]
-    
-    if type == 'choropleth':
-        plotdata[0]['z'] = logcounts
-        #plotdata[0]['colorscale'] = scl,
-        plotdata[0]['autocolorscale'] = False
-        plotdata[0]['showscale'] = False
-        plotdata[0]['zauto'] = False
-        plotdata[0]['zmax'] = logcounts.abs().max()
-        plotdata[0]['zmin'] = -logcounts.abs().max()
-    elif type == 'scattergeo':
-        plotdata[0]['marker']['size'] = logcounts.abs()
-        plotdata[0]['marker']['color'] = logcounts
-        plotdata[0]['marker']['cauto'] = False
-        plotdata[0]['marker']['cmax'] = logcounts.abs().max()
-        plotdata[0]['marker']['cmin'] = -logcounts.abs().max()
-    
-    layout = dict(
-            title = title,
-            margin=go.Margin(
-            l=10,r=10, b=10, t=50, pad=4
-        ),
-            geo = dict(
-                scope=scope,
-                projection=dict( type=projection ),
-                showframe = False,
-                showcoastlines = True,
-                showland = True,
-                landcolor = "rgb(229, 229, 229)",
-                countrycolor = "rgb(255, 255, 255)" ,
-                coastlinecolor = "rgb(255, 255, 255)",
-                showlakes = True,
-                lakecolor = 'rgb(255, 255, 255)')
-            )
-    return (plotdata, layout)
+def serve_layout(params=None):
+    # Pre-load values from /q=word,compare_word,type,scope URLs
+    q = dict(zip(keys,defaults))
+    if params is not None:
+        q.update(zip(keys,params))
+    word_query = dict(word=q['word'], compare=q['compare_word'])
+    # The first map comes with the layout (from the result cache, for the
+    # defaults), so landing on the page fires no server callbacks unless it is partial
+    fig, shown, refine, request = landing_map(word_query, q['type'], q['scope'])
 
-app.layout = html.Div([
+    return html.Div([
      html.Div([
         html.Div([
                 dcc.Markdown(header),
                 html.Div(
                     [html.Label("Search For a Term", className='mb-2'),
                         html.Br(),
-                        dcc.Input(id='search-term', type='text', value=q['word'],
+                        dcc.Input(id='search-term', type='text', value=q['word'], list='map-search-suggestions',
                             style={'color': 'darkorange','font-weight':'bold'}),
-                     dcc.Input(id='map-search-term-hidden', type='hidden',
-                               value=json.dumps(dict(word=q['word'], compare=q['compare_word']))),
+                     html.Datalist(id='map-search-suggestions'),
+                     # The words behind the current map, for the example books
+                     dcc.Store(id='map-query', data=word_query),
                      html.Br(),
                         html.Small("Combine search words with a comma. Only single word queries supported."),
                             ],
@@ -182,8 +62,9 @@ app.layout = html.Div([
                 ),
                 html.Div(
                     [html.Label("Optional: Compare to another term", className='mb-2'),
-                        dcc.Input(id='compare-term', type='text', value=q['compare_word'],
-                            style={'color': 'navy','font-weight':'bold'})],
+                        dcc.Input(id='compare-term', type='text', value=q['compare_word'], list='map-compare-suggestions',
+                            style={'color': 'navy','font-weight':'bold'}),
+                     html.Datalist(id='map-compare-suggestions')],
                     className="form-group mb-3"
                 ),
                 html.Button('Query', id='words_search_button', className='btn btn-primary', disabled=False),
@@ -216,7 +97,17 @@ app.layout = html.Div([
             ],
             className='col-md-3 px-3'),
         html.Div(
-            [dcc.Graph(id='main-map-graph', animate=False, config=graphconfig)],
+            [dcc.Graph(id='main-map-graph', figure=fig, animate=False, config=graphconfig),
+             # Set when the full map is still to come, see progressive.py
+             dcc.Store(id='map-refine'),
+             # The refine of a partial landing map, started in the browser
+             dcc.Store(id='map-landing-refine', data=refine),
+             # Token of the latest search, and the full map once it is ready:
+             # a refine is only shown if no search was made since
+             dcc.Store(id='map-request', data=request),
+             dcc.Store(id='map-refined'),
+             # The full map on screen, to send only what changes (see patches.py)
+             dcc.Store(id='map-shown', data=shown)],
             className='col-md-9')
     ], className='row'),
       html.Div([
@@ -224,35 +115,59 @@ app.layout = html.Div([
             dcc.Markdown("""**Example Books**
             Choose a place on the map to see matching books from there. All search and compare words included in matches.
             """),
-            html.Div(id='select-data'),
+            html.Div(id='select-data', children=nothing_selected()),
         ], className='col-md-offset-4 col-md-8')
       ], className='row')
     ], className='container-fluid')
 
+app.layout = serve_layout
+
+def landing_map(word_query, maptype, mapscope):
+    ''' The map to embed in the layout, its *-shown and *-refine data, and the request token '''
+    args = (word_query['word'], word_query['compare'], maptype, mapscope)
+    try:
+        fig, pending = render_map(args)
+    except Exception as error:
+        return search_error(error, word_query=word_query, maptype=maptype, mapscope=mapscope), None, None, None
+    if pending:
+        request = uuid.uuid4().hex
+        return fig, None, dict(args=args, requested=time.time(), request=request), request
+    return fig, patches.shown(args, fig), None, None
+
+def render_map(args):
+    ''' progressive.render() for map_figure(*args) '''
+    word, compare_word, maptype, mapscope = args
+    if compare_word and compare_word.strip() != '':
+        # The searched word on its own comes first
+        return progressive.render(map_figure, args, map_figure, (word, '', maptype, mapscope),
+                                  note='(loading \'%s\'…)' % compare_word)
+    return progressive.render(map_figure, args)
+
+def nothing_selected():
+    return html.Ul(html.Li(html.Em("Nothing selected")))
+
 @app.callback(
     Output('select-data', 'children'),
     Input('main-map-graph', 'clickData'),
-    State('search-term', 'value'),
-    State('compare-term', 'value'),
-    State('map_scope', 'value')
+    State('map-query', 'data'),
+    State('map_scope', 'value'),
+    prevent_initial_call=True
 )
-def display_click_data(clickData, word, compare_word, mapscope):
-    import json
+def display_click_data(clickData, word_query, mapscope):
     import re
     try:
         limit = clickData['points'][0]['text'].split('<br>')[0]
     except:
-        return html.Ul(html.Li(html.Em("Nothing selected")))
+        return nothing_selected()
+    word = word_query['word']
+    compare_word = word_query['compare']
     if compare_word and compare_word.strip() != '':
         word = word + "," + compare_word
-    q = word.split(",")
-        
-    bw_html.search_limits = { 'publication_' + mapscope : [limit], 'word': q }
-    results = bw_html.run()
-    
+    q = split_words(word)
+
     # Format results
     links = []
-    for result in results.json():
+    for result in get_example_books({ 'publication_' + mapscope : [limit], 'word': q }):
         try:
             groups = re.search("href=(.*)><em>(.*?)</em> \((.*?)\)", result).groups()
             link = html.Li(html.A(href=groups[0], target='_blank', children=["%s (%s)" % (groups[1], groups[2])]))
@@ -261,6 +176,22 @@ def display_click_data(clickData, word, compare_word, mapscope):
             raise
     return html.Ul(links)
 
+@app.callback(
+    Output('map-search-suggestions', 'children'),
+    Input('search-term', 'value'),
+    prevent_initial_call=True
+)
+def suggest_search_terms(word):
+    return [html.Option(value=completion) for completion in vocab.complete(word)]
+
+@app.callback(
+    Output('map-compare-suggestions', 'children'),
+    Input('compare-term', 'value'),
+    prevent_initial_call=True
+)
+def suggest_compare_terms(word):
+    return [html.Option(value=completion) for completion in vocab.complete(word)]
+
 #@app.callback(
 #    Output('words_search_button','disabled'),
 #    Output('words_search_button','children'),
@@ -274,34 +205,111 @@ def display_click_data(clickData, word, compare_word, mapscope):
 #    else:
 #        return True, [dbc.Spinner(size='sm',show_initially=True),' Querying...']
 
+# One round-trip per click: the search terms are read as State, not passed on
+# through a hidden input that triggers a second callback.
 @app.callback(
-    Output('map-search-term-hidden', 'value'),
+    Output('main-map-graph', 'figure'),
+    Output('map-query', 'data'),
+    Output('map-refine', 'data'),
+    Output('map-shown', 'data'),
+    Output('map-request', 'data'),
     Input('words_search_button', 'n_clicks'),
+    Input('map_type', 'value'),
+    Input('map_scope', 'value'),
     State('search-term', 'value'),
-    State('compare-term', 'value')
+    State('compare-term', 'value'),
+    State('map-query', 'data'),
+    State('map-shown', 'data'),
+    prevent_initial_call=True
 )
-def update_hidden_search_term(n_clicks, word, compare):
-    logging.debug("Triggered update_hidden_search_term")
-    return json.dumps(dict(word=word, compare=compare))
+def map_search(n_clicks, maptype, mapscope, word, compare_word, word_query, shown):
+    # Switching the map type or scope keeps the words that were last searched
+    if word_query is None or dash.ctx.triggered_id == 'words_search_button':
+        word_query = dict(word=word, compare=compare_word)
+    word = word_query['word']
+    compare_word = word_query['compare']
+    refine = dash.no_update
+    new_shown = None
+    request = uuid.uuid4().hex
+    try:
+        args = (word, compare_word, maptype, mapscope)
+        fig, pending = render_map(args)
+        if pending:
+            refine = dict(args=args, requested=time.time(), request=request)
+        else:
+            new_shown = patches.shown(args, fig)
+            fig = patches.replace(map_figure, shown, fig)
+    except Exception as error:
+        fig = search_error(error, word_query=word_query, maptype=maptype, mapscope=mapscope)
+    if new_shown is not None:
+        # Warm up what the user is likely to look at next
+        prefetch.map_siblings(*args)
+    return fig, word_query, refine, new_shown, request
 
 @app.callback(
-    Output('main-map-graph', 'figure'),
-    Input('map-search-term-hidden', 'value'),
-    Input('map_type', 'value'),
-    Input('map_scope', 'value')
+    Output('map-refined', 'data'),
+    Input('map-refine', 'data'),
+    State('map-request', 'data'),
+    prevent_initial_call=True
 )
-def map_search(word_query, maptype, mapscope):
+def map_refine(refine, request):
+    # Another search was made before this refine even started
+    if refine['request'] != request:
+        return dash.no_update
+    args = tuple(refine['args'])
     try:
-        word_query=json.loads(word_query)
-        word = word_query['word']
-        compare_word = word_query['compare']
-        plotdata, layout = build_map(word, compare_word, maptype, mapscope)
-        fig = dict( data=plotdata, layout=layout )
-    except:
-        logging.exception(json.dumps(dict(page='map', word_query=word_query,
-                                          maptype=maptype, mapscope=mapscope)))
-        fig = errorfig()
-    return fig
+        fig = progressive.refine(map_figure, args)
+    except Exception as error:
+        return dict(request=refine['request'], figure=search_error(error, args=args), shown=None)
+    # Past the deadline, leave the partial map on screen
+    if fig is None:
+        return dash.no_update
+    prefetch.map_siblings(*args)
+    return dict(request=refine['request'], figure=fig, shown=patches.shown(args, fig))
+
+# Only a partial landing map starts a refine, so landing on a complete one
+# fires no server callback
+app.clientside_callback(
+    '''
+    function(refine) {
+        return refine || window.dash_clientside.no_update;
+    }
+    ''',
+    Output('map-refine', 'data', allow_duplicate=True),
+    Input('map-landing-refine', 'data'),
+    prevent_initial_call='initial_duplicate'
+)
+
+# Checked in the browser, where the latest search's token is known by the time
+# the full map arrives
+app.clientside_callback(
+    '''
+    function(refined, request) {
+        if (!refined || refined.request !== request) {
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+        }
+        return [refined.figure, refined.shown];
+    }
+    ''',
+    Output('main-map-graph', 'figure', allow_duplicate=True),
+    Output('map-shown', 'data', allow_duplicate=True),
+    Input('map-refined', 'data'),
+    State('map-request', 'data'),
+    prevent_initial_call=True
+)
+
+def search_error(error, **context):
+    ''' Figure to show in place of a failed map '''
+    if isinstance(error, BackendBusy):
+        return busyfig()
+    if isinstance(error, BackendUnavailable):
+        return unavailablefig()
+    if isinstance(error, UnknownWords):
+        return unknownfig(error.suggestions)
+    if isinstance(error, NoResults):
+        return noresultsfig(error.args[0])
+    logging.exception(json.dumps(dict(page='map', **context)))
+    return errorfig()
 
 if __name__ == '__main__':
     app.config.supress_callback_exceptions = True
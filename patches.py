@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''
+Partial figure updates.
+
+When the page already shows the figure for one set of controls and the user
+changes one of them, update() compares the shown and the new figure and sends
+a dash.Patch with just the differences: a changed title, the rows that were
+added or removed from a heatmap, the years trimmed off or added to either end
+of each row, the keys that differ between map traces. Whenever the patch would
+not be smaller than the figure itself, the whole figure is sent instead.
+
+Pages keep the arguments and a digest of the figure on screen (see shown()).
+A patch is only sent if the cached figure for those arguments still has that
+digest: a background refresh may have replaced it since it was drawn, and a
+patch against the new one would not apply to what the browser has.
+'''
+import difflib
+import hashlib
+import json
+
+import dash
+import plotly
+
+# Size of the envelope of one patch operation in the response, without its
+# location and value
+OPERATION_SIZE = 55
+
+def _plain(fig):
+    ''' The figure as the browser sees it '''
+    return json.loads(json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder))
+
+def _digest(plain):
+    return hashlib.sha1(json.dumps(plain).encode('utf-8')).hexdigest()
+
+def _arguments(value):
+    # JSON turns the tuples of the arguments into lists
+    return tuple(_arguments(item) for item in value) if isinstance(value, list) else value
+
+def _size(value):
+    return len(json.dumps(value))
+
+def _cost(ops):
+    return sum(OPERATION_SIZE + _size(path) + (0 if value is None else _size(value)) for op, path, value in ops)
+
+def _diff_list(old, new, path):
+    ops = []
+    matcher = difflib.SequenceMatcher(None, [json.dumps(item) for item in old],
+                                      [json.dumps(item) for item in new], autojunk=False)
+    # Work from the end, so the indices of the earlier operations stay valid
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            continue
+        if tag == 'replace' and i2 - i1 == j2 - j1:
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                ops += _diff(old[i], new[j], path + [i])
+            continue
+        for i in reversed(range(i1, i2)):
+            ops.append(('delete', path + [i], None))
+        for j in reversed(range(j1, j2)):
+            ops.append(('insert', path + [i1], new[j]))
+    return ops
+
+def _diff(old, new, path):
+    ''' Operations that turn old into new, or a single assignment if that is cheaper '''
+    if old == new:
+        return []
+    assign = [('assign', path, new)]
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [('delete', path + [key], None) for key in old if key not in new]
+        for key, value in new.items():
+            ops += _diff(old[key], value, path + [key]) if key in old else [('assign', path + [key], value)]
+    elif isinstance(old, list) and isinstance(new, list):
+        ops = _diff_list(old, new, path)
+    else:
+        return assign
+    return ops if not path or _cost(ops) < _cost(assign) else assign
+
+def _apply(patch, ops):
+    for op, path, value in ops:
+        target = patch
+        for key in path[:-1]:
+            target = target[key]
+        if op == 'assign':
+            target[path[-1]] = value
+        elif op == 'delete':
+            del target[path[-1]]
+        else:
+            target.insert(path[-1], value)
+    return patch
+
+def update(old, new):
+    ''' What to send to turn the shown figure `old` into `new`: a dash.Patch, `new` itself or no_update '''
+    plain = _plain(new)
+    ops = _diff(_plain(old), plain, [])
+    if not ops:
+        return dash.no_update
+    if _cost(ops) >= _size(plain):
+        return new
+    return _apply(dash.Patch(), ops)
+
+def shown(args, fig):
+    ''' What to keep in a page's store about the figure func(*args) it now shows '''
+    return dict(args=args, digest=_digest(_plain(fig)))
+
+def replace(func, on_screen, fig):
+    ''' Update from the figure described by shown() to fig '''
+    if on_screen is None:
+        return fig
+    args = _arguments(on_screen['args'])
+    # Only diff against figures that are cheap to rebuild
+    if not func.is_cached(*args):
+        return fig
+    old = func(*args)
+    if _digest(_plain(old)) != on_screen['digest']:
+        return fig
+    return update(old, fig)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+'''
+Fill the result cache ahead of time from a word list, e.g. before a demo:
+
+    python precompute.py words.txt --facets lc_classes,languages --scopes country,state
+
+Words are read one per line ('-' reads stdin); a line can hold a comma
+separated word list, just like the search box. Map data, heatmap data and the
+default map figures are computed across a process pool and written to the
+shared result cache (see cache.py), so the app's next requests are hits.
+Heatmap figures are only cached in memory, so each worker draws them from the
+cached heatmap data. Backend queries from all processes together are held to
+--rate per second.
+
+The data behind the map and heatmap pages' default layouts is always included,
+so landing on the app sends no queries to Bookworm either.
+'''
+import argparse
+import logging
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import figures
+import progressive
+import queries
+import tools
+
+# Pages whose default layout embeds figures drawn from cached data
+LANDING_PAGES = ['map.py', 'heatmap.py']
+
+class RateLimiter:
+    ''' Spaces out calls across processes to at most `rate` per second '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = multiprocessing.Lock()
+        self.next_time = multiprocessing.Value('d', 0.0, lock=False)
+
+    def __call__(self):
+        with self.lock:
+            now = time.time()
+            wait = self.next_time.value - now
+            self.next_time.value = max(now, self.next_time.value) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+def init_worker(limiter):
+    queries.throttle = limiter
+
+def precompute_map(word, scope, types):
+    if scope == 'country':
+        queries.get_word_by_country(word)
+    else:
+        queries.get_word_by_us_state(word)
+    # The map page sends an empty compare term when there is none
+    for maptype in types:
+        figures.map_figure(word, '', maptype, scope)
+
+def precompute_heatmap(word, facet):
+    queries.get_heatmap_values(word, facet, figures.max_facet_values,
+                               hard_min_year=figures.hard_min_year, hard_max_year=figures.hard_max_year)
+    # The heatmap page's facet value options; the figure itself is drawn by each worker
+    queries.get_facet_value_options(facet)
+
+def precompute_landing(path):
+    # Rendering the default layout computes everything it embeds, when it
+    # waits for the full figures rather than leaving them to a refine
+    progressive.enabled = False
+    tools.load_page(path)()
+
+def read_words(path):
+    words_file = sys.stdin if path == '-' else open(path, 'r')
+    with words_file:
+        return [line.strip() for line in words_file if line.strip() and not line.startswith('#')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-populate the result cache from a word list.')
+    parser.add_argument('words', help="file with one search term per line, or '-' for stdin")
+    parser.add_argument('--facets', default='lc_classes', help='comma separated heatmap facets (default: %(default)s)')
+    parser.add_argument('--scopes', default='country,state', help='comma separated map scopes (default: %(default)s)')
+    parser.add_argument('--types', default='scattergeo,choropleth', help='comma separated map types (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=4, help='worker processes (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=2.0, help='max Bookworm queries per second (default: %(default)s)')
+    args = parser.parse_args()
+
+    facets = [facet for facet in args.facets.split(',') if facet]
+    scopes = [scope for scope in args.scopes.split(',') if scope]
+    types = [maptype for maptype in args.types.split(',') if maptype]
+    for value, options in [(scopes, figures.map_scopes), (types, figures.map_types)]:
+        unknown = set(value) - set(options)
+        if unknown:
+            parser.error("Unknown value(s): %s" % ', '.join(sorted(unknown)))
+
+    words = read_words(args.words)
+    limiter = RateLimiter(args.rate)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=init_worker, initargs=(limiter,)) as pool:
+        tasks = {}
+        for path in LANDING_PAGES:
+            tasks[pool.submit(precompute_landing, path)] = (path, 'defaults')
+        for word in words:
+            for scope in scopes:
+                tasks[pool.submit(precompute_map, word, scope, types)] = (word, scope)
+            for facet in facets:
+                tasks[pool.submit(precompute_heatmap, word, facet)] = (word, facet)
+        for done, future in enumerate(as_completed(tasks), 1):
+            try:
+                future.result()
+                logging.info("[%d/%d] %s / %s" % ((done, len(tasks)) + tasks[future]))
+            except Exception:
+                failed += 1
+                logging.exception("[%d/%d] %s / %s failed" % ((done, len(tasks)) + tasks[future]))
+
+    print("Precomputed %d words: %d tasks, %d failed" % (len(words), len(tasks), failed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+'''
+Speculative prefetch of the views a user is likely to open next.
+
+After a map or heatmap search, the figures one click away (the other map
+type and scope, the heatmap of the same word, the maps of a heatmap's word)
+are computed in the background and land in the result cache, so those clicks
+are cache hits.
+
+Prefetching never gets in the way of real searches: it runs on a couple of
+threads, its queries only use backend slots that are free right now (see
+queries.guarded), and at most `max_pending` prefetches are queued per process.
+Each browser may start `budget` prefetches per `window` seconds. The count is
+kept in a signed cookie, so every worker sees the same one and it survives
+worker restarts; set `secret_key` in config.json so that it also survives
+restarts of the whole app.
+'''
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dash
+import flask
+from itsdangerous import BadData, URLSafeSerializer
+
+import figures
+import queries
+from queries import settings
+
+enabled = settings.get('prefetch', True)
+budget = settings.get('prefetch_budget', 20)
+window = settings.get('prefetch_window', 600)
+max_pending = settings.get('prefetch_queue', 32)
+threads = settings.get('prefetch_threads', 2)
+
+COOKIE = 'bookworm_prefetch'
+# The heatmap page's default facet
+HEATMAP_FACET = 'lc_classes'
+
+# Without a configured key, one is made up when the app is loaded: gunicorn
+# loads it once, before forking the workers, so they all share it
+_signer = URLSafeSerializer(settings.get('secret_key') or os.urandom(32).hex(), salt='prefetch')
+
+def _background():
+    queries.background.active = True
+
+_pool = ThreadPoolExecutor(max_workers=threads, initializer=_background)
+_pending = set()
+_lock = threading.Lock()
+
+def _after_fork():
+    global _pool, _pending, _lock
+    _pool = ThreadPoolExecutor(max_workers=threads, initializer=_background)
+    _pending = set()
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def _budget():
+    ''' When the browser's current window started and how many prefetches it has used, from its cookie '''
+    now = time.time()
+    try:
+        started, used = _signer.loads(flask.request.cookies.get(COOKIE, ''))
+    except (BadData, TypeError, ValueError):
+        return now, 0
+    if now - started > window:
+        return now, 0
+    return started, used
+
+def _run(key, func, args):
+    try:
+        func(*args)
+        logging.debug("Prefetched %s%r" % key)
+    except Exception as error:
+        # Shed, or a failure that is cached for the real request anyway
+        logging.debug("Prefetch of %s%r failed: %r" % (key + (error,)))
+    finally:
+        with _lock:
+            _pending.discard(key)
+
+def schedule(jobs):
+    ''' Compute each (cached function, args) in the background, unless it is cached already '''
+    if not enabled:
+        return
+    started, used = _budget()
+    spent = 0
+    for func, args in jobs:
+        key = (func.__name__, args)
+        if used + spent >= budget:
+            break
+        if func.is_cached(*args):
+            continue
+        with _lock:
+            if key in _pending:
+                continue
+            if len(_pending) >= max_pending:
+                break
+            _pending.add(key)
+        spent += 1
+        _pool.submit(_run, key, func, args)
+    if spent:
+        dash.callback_context.response.set_cookie(COOKIE, _signer.dumps([started, used + spent]), max_age=window,
+                                                  httponly=True, samesite='Lax')
+
+def heatmap_data(word, facet=HEATMAP_FACET):
+    ''' Arguments of get_heatmap_values() for the heatmap page '''
+    return (word, facet, figures.max_facet_values, figures.hard_min_year, figures.hard_max_year)
+
+def map_siblings(word, compare_word, maptype, mapscope):
+    ''' After a map: the other map type and scope, and the heatmap of the word '''
+    jobs = [(figures.map_figure, (word, compare_word, other, mapscope)) for other in figures.map_types if other != maptype]
+    jobs += [(figures.map_figure, (word, compare_word, maptype, other)) for other in figures.map_scopes if other != mapscope]
+    jobs.append((queries.get_heatmap_values, heatmap_data(word)))
+    schedule(jobs)
+
+def heatmap_siblings(word, facet, facet_query, years):
+    ''' After a heatmap: the maps a search for the word on a freshly opened map page draws '''
+    # The map page keeps its default compare word in the search box
+    word_default, compare, maptype, scope_default = figures.map_defaults
+    schedule([(figures.map_figure, (word, compare, maptype, scope)) for scope in figures.map_scopes])
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+'''
+Opt-in profiling of individual requests.
+
+Set `profiling_token` in config.json to enable it. A request that carries the
+header `X-Profile: <token>` then runs under cProfile, including the Dash
+callback, the Bookworm query and the pandas work, and the result is saved to
+`profile_dir` (default `profiles/`) as `<timestamp>-<pid>-<callback>.pstats`. The
+file name is returned in the `X-Profile-Path` response header. Read it with
+`python -m pstats`, or render a flame graph with e.g. `flameprof` or `snakeviz`.
+
+To profile every request a worker serves, flip the admin toggle:
+
+    curl -X POST -H 'X-Profile: <token>' '.../app/admin/profiling?enabled=1'
+
+The toggle is per worker process. Without a token no hooks are installed, so
+profiling costs nothing when it is off.
+
+cProfile only sees the request's own thread, so a profiled request computes its
+figures there rather than on progressive.py's thread pool. Waiting on Bookworm
+itself still shows up as waiting on the event loop of aioquery.py.
+'''
+import cProfile
+import hmac
+import json
+import logging
+import os
+import re
+import time
+
+from flask import request, g, abort, jsonify, has_request_context
+
+def active():
+    ''' True while the current request is being profiled '''
+    return has_request_context() and 'profiler' in g
+
+def init_app(server, settings, url_base_pathname='/'):
+    token = settings.get('profiling_token')
+    if not token:
+        return
+    directory = settings.get('profile_dir', 'profiles')
+    state = dict(enabled=False)
+
+    def authorized():
+        return hmac.compare_digest(request.headers.get('X-Profile', ''), token)
+
+    def label():
+        # Name Dash callback profiles after their outputs
+        if request.path.endswith('_dash-update-component'):
+            body = request.get_json(silent=True) or {}
+            return body.get('output', 'callback')
+        return request.path
+
+    @server.before_request
+    def start_profile():
+        if state['enabled'] or ('X-Profile' in request.headers and authorized()):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @server.after_request
+    def save_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        now = time.time()
+        name = '%s%03d-%d-%s.pstats' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), (now % 1) * 1000, os.getpid(),
+                                        re.sub(r'[^A-Za-z0-9_.-]+', '_', label()).strip('_.')[:80])
+        try:
+            os.makedirs(directory, exist_ok=True)
+            profiler.dump_stats(os.path.join(directory, name))
+            response.headers['X-Profile-Path'] = name
+            logging.info(json.dumps(dict(profile=name, path=request.path)))
+        except OSError:
+            logging.exception("Could not save profile %s" % name)
+        return response
+
+    @server.route(url_base_pathname + 'admin/profiling', methods=['GET', 'POST'])
+    def profiling_toggle():
+        if not authorized():
+            abort(403)
+        if request.method == 'POST':
+            state['enabled'] = request.args.get('enabled', '0') == '1'
+            logging.warning("Profiling of all requests %s in worker %d" % ('enabled' if state['enabled'] else 'disabled', os.getpid()))
+        return jsonify(enabled=state['enabled'], pid=os.getpid(), directory=directory)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Progressive rendering for the map and heatmap pages.
+
+A search first waits at most `coarse_deadline` seconds. If the full figure is
+ready by then it is shown right away. Otherwise a cheaper coarse figure (e.g.
+the heatmap's top few facet values) is shown as soon as it is ready, within
+another `coarse_deadline` seconds (or a placeholder after that), and the
+page fires a refine callback that swaps in the full figure once it completes.
+If the full figure misses `refine_deadline` the coarse one stays on screen,
+and the query keeps running in the background to fill the cache.
+
+The figure functions run on a small thread pool, and identical calls that are
+already running are joined rather than started twice. A refine usually lands
+on another worker than its search; there the result cache's in-flight markers
+(see cache.py) make it wait for the queries the search started.
+'''
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, FIRST_COMPLETED, wait
+
+import plotly.graph_objs as go
+
+import profiling
+from queries import settings
+from tools import loadingfig
+
+enabled = settings.get('progressive', True)
+coarse_deadline = settings.get('coarse_deadline', 2)
+refine_deadline = settings.get('refine_deadline', 60)
+
+_pool = ThreadPoolExecutor(max_workers=settings.get('progressive_threads', 8))
+_running = {}
+_running_lock = threading.Lock()
+
+def _after_fork():
+    # A pool started before a fork has no threads in the child
+    global _pool, _running, _running_lock
+    _pool = ThreadPoolExecutor(max_workers=settings.get('progressive_threads', 8))
+    _running = {}
+    _running_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def submit(func, *args):
+    ''' Run func(*args) on the pool, or join the same call if it is already running '''
+    key = (func.__name__, args)
+    with _running_lock:
+        future = _running.get(key)
+        if future is None:
+            future = _pool.submit(func, *args)
+            _running[key] = future
+            future.add_done_callback(lambda future: _forget(key, future))
+    return future
+
+def _forget(key, future):
+    with _running_lock:
+        if _running.get(key) is future:
+            del _running[key]
+
+def _partial(fig, note):
+    ''' Copy of a cached figure with the note added to its title '''
+    layout = fig['layout']
+    layout = dict(layout.to_plotly_json() if isinstance(layout, go.Layout) else layout)
+    title = layout.get('title')
+    title = title.get('text', '') if isinstance(title, dict) else (title or '')
+    layout['title'] = '%s %s' % (title, note)
+    return dict(fig, layout=layout)
+
+def render(full, args, coarse=None, coarse_args=None, note='(loading…)'):
+    ''' Returns the figure to show now, and whether the full figure is still to come '''
+    # Profiled requests run everything on their own thread, where cProfile sees it
+    if not enabled or profiling.active() or full.is_cached(*args):
+        return full(*args), False
+
+    full_future = submit(full, *args)
+    coarse_future = None if coarse is None else submit(coarse, *coarse_args)
+    try:
+        return full_future.result(timeout=coarse_deadline), False
+    except TimeoutError:
+        pass
+    # Then whichever comes first, the full figure or the coarse one
+    pending = { full_future } if coarse_future is None else { full_future, coarse_future }
+    deadline = time.time() + coarse_deadline
+    while pending:
+        done, pending = wait(pending, timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        if full_future in done:
+            return full_future.result(), False
+        if coarse_future.exception() is None:
+            return _partial(coarse_future.result(), note), True
+        # Without a coarse figure, keep waiting for the full one
+        logging.info("Coarse %s%r failed: %r" % (coarse.__name__, coarse_args, coarse_future.exception()))
+    logging.info("%s%r missed the %ss deadline, showing a placeholder" % (full.__name__, args, coarse_deadline))
+    return loadingfig(), True
+
+def refine(full, args):
+    ''' The full figure, or None if it misses the deadline '''
+    if profiling.active():
+        return full(*args)
+    try:
+        return submit(full, *args).result(timeout=refine_deadline)
+    except TimeoutError:
+        logging.warning("%s%r missed the refine deadline" % (full.__name__, args))
+        return None
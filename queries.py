@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+'''
+Bookworm queries shared by the pages and the figure API.
+'''
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+import bwypy
+import pandas as pd
+
+import aioquery
+import bar_cube
+import cache
+import local_engine
+import vocab
+from cache import cached
+from tools import get_facet_group_options, map_to_human_readable, human_readable_labels
+
+with open('config.json','r') as options_file:
+    bwypy_options = json.load(options_file)
+settings = bwypy_options['settings']
+
+bwypy.set_options(database=settings['dbname'], endpoint=settings['endpoint'])
+cache.configure(settings.get('cache_dir', 'cache'), settings.get('cache_ttl'), settings.get('negative_cache_ttl'),
+                settings.get('cache_max_mb', 4096))
+
+# Bookworm requests go through one event loop and connection pool per process
+aioquery.configure(settings.get('backend_connections'), settings.get('backend_timeout', 30))
+
+# Only used for field metadata. Queries get their own BWQuery from new_query(),
+# because requests and background cache refreshes run them concurrently.
+bw = aioquery.AsyncQuery(verify_fields=False,verify_cert=False)
+
+def new_query(**json):
+    query = aioquery.AsyncQuery(verify_fields=False,verify_cert=False)
+    query.json['words_collation'] = 'case_insensitive'
+    query.json.update(json)
+    return query
+
+country_codes = pd.read_csv('data/country_codes.csv')
+state_codes = pd.read_csv('data/state_codes_us.csv')
+
+# Facets that have human readable labels in data/map_to_human_readable.json
+labelled_facets = ['genres','languages','digitization_agent_code','format','htsource']
+
+# Everything on the bar chart is word-independent, so it is served from the
+# materialized cube (see bar_cube.py) when one has been built. Whether there is
+# one is checked on every query, so a cube built while the app runs is used.
+if bar_cube.available():
+    facet_opts = bar_cube.facet_group_options()
+else:
+    logging.warning("No bar chart cube at %s, querying Bookworm directly" % bar_cube.CUBE_PATH)
+    facet_opts = get_facet_group_options(bw)
+
+class BackendBusy(cache.Transient):
+    ''' Raised instead of queueing when too many backend queries are in flight '''
+
+class BackendUnavailable(cache.Transient):
+    ''' Raised without querying while the circuit breaker is open, and for connection errors, timeouts and 5xx responses '''
+
+class BackendError(Exception):
+    ''' Bookworm rejected the query. Unlike aiohttp's errors it pickles, so it can be cached. '''
+    def __init__(self, status, message=''):
+        super().__init__(status, message)
+        self.status = status
+
+class NoResults(Exception):
+    ''' The query ran but matched nothing, e.g. a misspelled word '''
+
+class UnknownWords(NoResults):
+    ''' Search terms that are not in the vocabulary, so would match nothing '''
+    def __init__(self, words, suggestions):
+        super().__init__(','.join(words), suggestions)
+        self.words = words
+        self.suggestions = suggestions
+
+    def __reduce__(self):
+        # Failures are pickled into the result cache
+        return (UnknownWords, (self.words, self.suggestions))
+
+# Called before every backend query; precompute.py installs a rate limiter here
+throttle = None
+
+# Admission control: at most max_inflight backend queries per process. Others
+# wait up to queue_timeout seconds for their slots and are then shed.
+max_inflight = settings.get('max_backend_queries', 4)
+queue_timeout = settings.get('backend_queue_timeout', 5)
+_inflight = 0
+_slots = threading.Condition()
+# Set in background threads (see prefetch.py): their queries only take a free
+# slot and never wait for one
+background = threading.local()
+
+# Circuit breaker: after breaker_threshold consecutive failures (connection
+# errors, timeouts and 5xx responses, see _backend_failure()), queries fail
+# fast for breaker_reset seconds. Then a single probe query is let through,
+# which closes the breaker if it succeeds and re-opens it if it fails.
+breaker_threshold = settings.get('breaker_threshold', 5)
+breaker_reset = settings.get('breaker_reset', 30)
+_breaker = dict(failures=0, opened_at=None, probing=False)
+_breaker_lock = threading.Lock()
+
+def _admit():
+    ''' Returns True if this query is the probe of a half-open breaker '''
+    with _breaker_lock:
+        if _breaker['opened_at'] is None:
+            return False
+        if not _breaker['probing'] and time.time() - _breaker['opened_at'] > breaker_reset:
+            _breaker['probing'] = True
+            logging.info("Circuit breaker half-open, probing Bookworm")
+            return True
+    raise BackendUnavailable()
+
+def _record(ok):
+    with _breaker_lock:
+        if ok:
+            if _breaker['opened_at'] is not None:
+                logging.warning("Bookworm is back, closing circuit breaker")
+            _breaker.update(failures=0, opened_at=None, probing=False)
+            return
+        _breaker['failures'] += 1
+        if _breaker['probing'] or _breaker['failures'] >= breaker_threshold:
+            if not _breaker['probing']:
+                logging.error("%d Bookworm queries failed in a row, opening circuit breaker" % _breaker['failures'])
+            _breaker.update(opened_at=time.time(), probing=False)
+
+def check_available():
+    ''' Raise BackendUnavailable if queries would be failed fast right now, without taking the probe '''
+    with _breaker_lock:
+        opened_at = _breaker['opened_at']
+        if opened_at is not None and (_breaker['probing'] or time.time() - opened_at <= breaker_reset):
+            raise BackendUnavailable()
+
+def _release_probe():
+    # Let the next query probe instead
+    with _breaker_lock:
+        _breaker['probing'] = False
+
+def _backend_failure(error):
+    ''' True for errors that say Bookworm is down or overloaded, rather than something about the query '''
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+def _acquire(slots, timeout):
+    ''' Take all the slots at once, so that concurrent batches cannot each hold some '''
+    global _inflight
+    with _slots:
+        if not _slots.wait_for(lambda: _inflight + slots <= max_inflight, timeout):
+            return False
+        _inflight += slots
+        return True
+
+def _release(slots):
+    global _inflight
+    with _slots:
+        _inflight -= slots
+        _slots.notify_all()
+
+def guarded(func, *args, slots=1):
+    ''' All Bookworm requests go through here; func sends `slots` queries '''
+    probe = _admit()
+    if throttle is not None:
+        for _ in range(slots):
+            throttle()
+    waits = not getattr(background, 'active', False)
+    if not _acquire(slots, queue_timeout if waits else 0):
+        if waits:
+            logging.warning("Shedding %d queries, %d backend queries in flight" % (slots, _inflight))
+        if probe:
+            _release_probe()
+        raise BackendBusy()
+    try:
+        result = func(*args)
+    except Exception as error:
+        # aiohttp's errors hold on to the request and cannot be pickled into
+        # the result cache, so they are replaced by our own
+        if _backend_failure(error):
+            _record(False)
+            raise BackendUnavailable(getattr(error, 'status', None)) from error
+        if isinstance(error, aiohttp.ClientResponseError):
+            # Bookworm answered, it just rejected the query
+            _record(True)
+            raise BackendError(error.status, error.message) from error
+        if probe:
+            # Failed before Bookworm could tell us anything
+            _release_probe()
+        raise
+    else:
+        _record(True)
+        return result
+    finally:
+        _release(slots)
+
+def run(query):
+    return guarded(query.run)
+
+def run_all(queries):
+    ''' Several queries at once, in batches of at most max_inflight, each query taking a backend slot '''
+    results = []
+    for start in range(0, len(queries), max_inflight):
+        batch = queries[start:start + max_inflight]
+        results += guarded(aioquery.run_all, batch, slots=len(batch))
+    return results
+
+def _after_fork():
+    ''' Fresh locks in each child, whatever the parent was doing at fork time '''
+    global _inflight, _slots, _breaker_lock
+    _inflight = 0
+    _slots = threading.Condition()
+    _breaker_lock = threading.Lock()
+    _breaker.update(failures=0, opened_at=None, probing=False)
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def split_words(word):
+    return [token.strip() for token in word.split(',')]
+
+def check_words(word):
+    ''' Raise UnknownWords, with spelling suggestions, instead of querying for words Bookworm doesn't have '''
+    # The index only has single words, so phrases are left to Bookworm
+    unknown = vocab.unknown_words([token for token in split_words(word) if token and ' ' not in token])
+    if unknown:
+        raise UnknownWords(unknown, { token: vocab.close_matches(token) for token in unknown })
+
+# Word queries are built in one place, so that local_engine.py materializes
+# exactly the queries the app sends
+def us_state_query(words):
+    return new_query(counttype=['WordsPerMillion'], groups=['*publication_country', 'publication_state'],
+                     search_limits={ 'word':words, 'publication_country': 'United States' })
+
+def country_query(words):
+    return new_query(counttype=['WordsPerMillion'], groups=['publication_country'],
+                     search_limits={ 'word':words })
+
+def heatmap_query(words, facet, max_facet_values=15, hard_min_year=1650, hard_max_year=2015):
+    return new_query(counttype=['WordsPerMillion'], groups=[facet, 'date_year'],
+                     search_limits={ 'word': words, facet+'__id': { '$lt':max_facet_values+1 },
+                                     'date_year': { '$lt': hard_max_year, '$gt': hard_min_year } })
+
+word_queries = { 'country': country_query, 'state': us_state_query, 'heatmap': heatmap_query }
+
+def fetch_terms(kind, words):
+    ''' Single-word frames of a kind of query, from the local shard or from Bookworm all at once '''
+    word_query = word_queries[kind[0]]
+    queries = [word_query([word], *kind[1:]) for word in words]
+    frames = [local_engine.answer(query.json) for query in queries]
+    missing = [i for i, frame in enumerate(frames) if frame is None]
+    if missing:
+        for i, results in zip(missing, run_all([queries[i] for i in missing])):
+            frames[i] = results.frame(index=False, drop_unknowns=True)
+    return frames
+
+# Word queries are cached word by word. WordsPerMillion is additive over the
+# words of a word list (the denominator is the group's word total), so any
+# combination or reordering of cached words is answered without Bookworm.
+@cached('term_frame', maxsize=256)
+def term_frame(kind, word):
+    ''' results.frame() of a kind of word query for one word, e.g. kind=('country',) '''
+    return fetch_terms(kind, [word])[0]
+
+def word_frame(kind, words):
+    ''' results.frame() of a kind of word query for a word list, summed from the single words '''
+    # Queries use case insensitive collation, and a repeated word is only counted
+    # once. Empty entries ("a,,b") are dropped, as in check_words().
+    if not any(word.strip() for word in words):
+        raise NoResults(','.join(words))
+    words = list(dict.fromkeys(word.strip().lower() for word in words if word.strip()))
+    missing = [word for word in words if not term_frame.is_cached(kind, word)]
+    if len(missing) > 1:
+        for word, frame in zip(missing, fetch_terms(kind, missing)):
+            term_frame.put(frame, kind, word)
+    frames = [term_frame(kind, word) for word in words]
+    if len(frames) == 1:
+        # Callers modify the frame, which must not change the cached one
+        return frames[0].copy()
+    df = pd.concat(frames, ignore_index=True)
+    groups = list(df.columns[:-1])
+    # The shard and Bookworm disagree on the type of numeric groups like date_year
+    df[groups] = df[groups].astype(str)
+    return df.groupby(groups, sort=False)[df.columns[-1]].sum().reset_index()
+
+@cached('word_by_us_state')
+def get_word_by_us_state(word):
+    check_words(word)
+    df = word_frame(('state',), split_words(word))
+    data = pd.merge(df, state_codes)
+    if data.empty:
+        raise NoResults(word)
+    return data
+
+@cached('word_by_country')
+def get_word_by_country(word):
+    check_words(word)
+    df = word_frame(('country',), split_words(word))
+    data = pd.merge(df, country_codes)
+    if data.empty:
+        raise NoResults(word)
+    return data
+
+@cached('heatmap_values')
+def get_heatmap_values(query, facet, max_facet_values=15, hard_min_year=1650, hard_max_year=2015):
+    check_words(query)
+    # Get and format results
+    df = word_frame(('heatmap', facet, max_facet_values, hard_min_year, hard_max_year), split_words(query))
+    df = map_to_human_readable(df,facet)
+    df.date_year = df.date_year.astype(float).astype(int)
+    df = df[df[facet] != '0']
+    if df.empty:
+        raise NoResults(query)
+    return df
+
+@cached('facet_value_options')
+def get_facet_value_options(facet):
+    def trim(w, n=20):
+        if len(w)>n:
+            return w[:n]+'…'
+        else:
+            return w
+    values = [x for x in guarded(bw.field_values, facet, 40) if x.strip() != '']
+    logging.debug(values)
+    if facet in labelled_facets:
+        labels = human_readable_labels[facet]
+        return [{'label': trim(labels.get(x, x)), 'value': x} for x in values]
+    else:
+        return [{'label': trim(x), 'value': x} for x in values]
+
+def get_results(group, drop_unknowns=False):
+    return _results(group, drop_unknowns, bar_cube.version())
+
+# This will cache identical calls. cube is the cube's version, so a rebuilt cube
+# is not answered from the old one's results.
+@functools.lru_cache(maxsize=32)
+def _results(group, drop_unknowns, cube):
+    if cube is not None:
+        return bar_cube.get_results(group, drop_unknowns)
+    query = new_query(counttype=['WordCount', 'TextCount'], groups=['*'+group],
+                      search_limits={ group + '__id' : {"$lt": bar_cube.MAX_FACET_ID } })
+    return run(query).frame(index=False, drop_unknowns=drop_unknowns)
+
+def get_date_distribution(group, facet):
+    return _date_distribution(group, facet, bar_cube.version())
+
+@functools.lru_cache(maxsize=32)
+def _date_distribution(group, facet, cube):
+    if cube is not None:
+        df = bar_cube.get_date_distribution(group, facet)
+    else:
+        query = new_query(counttype=['TextCount'], groups=['date_year'], search_limits={ group: facet })
+        results = run(query)
+        df = results.frame(index=False)
+    logging.debug("Got date distribution")
+    logging.debug(df)
+    try:
+        df = map_to_human_readable(df,group)
+        logging.debug("Ran map to human readable")
+        logging.debug(df)
+    except Exception as e:
+        logging.error("ERROR with date distribution")
+        logging.error(e)
+    df.date_year = pd.to_numeric(df.date_year)
+    logging.debug("Converted dates to numeric")
+    df2 = df.query('(date_year > 1800) and (date_year < 2016)').sort_values('date_year', ascending=True)
+    df2['smoothed'] = df2.TextCount.rolling(10, 0).mean()
+    return df2
+
+def get_example_books(search_limits):
+    ''' Raw 'search_results' HTML snippets for the example book lists '''
+    return run(new_query(method='search_results', search_limits=search_limits)).json()
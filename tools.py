@@ -3,6 +3,7 @@ from dash import html, dcc
 import plotly.graph_objs as go
 import logging
 import json
+import functools
 
 logging_config = dict(
     version = 1,
@@ -63,6 +64,8 @@ def get_facet_group_options(bw):
                   bw.fields().query("type == 'character'").name if name != 'is_gov_doc']
     return options
 
+# Error figures are served a lot when Bookworm is down, so build each only once
+@functools.lru_cache(maxsize=64)
 def errorfig(txt='There was an error! We\'ve logged it and will try to fix it. Try something else!'): 
     data = [go.Heatmap(z=[0], x=[0], y=[['']], showscale=False )]
     layout = go.Layout(
@@ -74,11 +77,35 @@ def errorfig(txt='There was an error! We\'ve logged it and will try to fix it. T
     fig = go.Figure(data=data, layout=layout)
     return fig
 
-def map_to_human_readable(df,facet):
-    print("Loading JSON map")
-    with open('data/map_to_human_readable.json','r') as map_to_human_readable_file:
-        map_to_human_readable = json.load(map_to_human_readable_file)
+def busyfig():
+    return errorfig('The Bookworm server is busy right now. Please try again in a moment!')
+
+def loadingfig():
+    return errorfig('Still querying the HathiTrust, this one takes a while…')
+
+def unavailablefig():
+    return errorfig('The Bookworm server is not responding. Please try again in a minute!')
+
+def noresultsfig(word):
+    return errorfig('No results for \'%s\'. Check the spelling, or try another word!' % word)
 
+def unknownfig(suggestions):
+    txt = []
+    for word, matches in suggestions.items():
+        txt.append('\'%s\' is not in the HathiTrust vocabulary.' % word)
+        if matches:
+            txt.append('Did you mean: %s?' % ', '.join(matches))
+    return errorfig(' '.join(txt))
+
+# Label tables are read once at import, so with gunicorn --preload the workers
+# share the master's copy instead of re-reading the files on every request
+with open('data/map_to_human_readable.json','r') as map_to_human_readable_file:
+    human_readable_labels = json.load(map_to_human_readable_file)
+with open('data/map_to_ld.json','r') as map_to_ld_file:
+    ld_values = json.load(map_to_ld_file)
+
+def map_to_human_readable(df,facet):
+    map_to_human_readable = human_readable_labels
     print("Applying map")
     if facet in map_to_human_readable.keys():
 #        df = df.replace({ facet: map_to_human_readable[facet] })
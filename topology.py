@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''
+Serve the map topology (Plotly's topojson files) from the app instead of the
+Plotly CDN, so the map renders without a third-party round-trip and on
+isolated networks.
+
+Fetch the files once, e.g. when building the image:
+
+    python topology.py [--factor 4] [--output data/topojson]
+
+The world outline is pre-simplified by snapping it to a coarser grid, so the
+browser downloads and draws fewer points. Files are served gzipped under a
+content-hashed URL, so browsers can cache them for a year.
+'''
+import argparse
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+from urllib.request import urlopen
+
+from flask import request, send_from_directory, abort, redirect
+
+TOPOJSON_DIR = 'data/topojson'
+CDN_URL = 'https://cdn.plot.ly/'
+
+# {scope}_{resolution}m, as requested by plotly.js. The map only uses the
+# default 110m resolution.
+NAMES = ['world_110m', 'usa_110m']
+SIMPLIFIED = ['world_110m']
+
+max_age = 365*24*3600
+
+def simplify(topology, factor):
+    ''' Re-quantize a quantized topology onto a grid `factor` times coarser '''
+    if 'transform' not in topology or factor <= 1:
+        return topology
+    arcs = []
+    for arc in topology['arcs']:
+        x = y = 0
+        points = []
+        for dx, dy in arc:
+            x, y = x + dx, y + dy
+            point = (round(x / factor), round(y / factor))
+            # Arcs share their end points, so those snap to the same grid point
+            if not points or point != points[-1]:
+                points.append(point)
+        if len(points) == 1:
+            points.append(points[0])
+        deltas = [list(points[0])] + [[b[0] - a[0], b[1] - a[1]] for a, b in zip(points, points[1:])]
+        arcs.append(deltas)
+    scale = topology['transform']['scale']
+    return dict(topology, arcs=arcs, transform=dict(topology['transform'], scale=[scale[0] * factor, scale[1] * factor]))
+
+def fetch(directory=TOPOJSON_DIR, factor=4, base_url=CDN_URL):
+    os.makedirs(directory, exist_ok=True)
+    for name in NAMES:
+        with urlopen(base_url + name + '.json') as response:
+            topology = json.load(response)
+        points = sum(len(arc) for arc in topology['arcs'])
+        if name in SIMPLIFIED:
+            topology = simplify(topology, factor)
+        data = json.dumps(topology, separators=(',', ':')).encode('utf-8')
+        with open(os.path.join(directory, name + '.json'), 'wb') as topology_file:
+            topology_file.write(data)
+        with gzip.open(os.path.join(directory, name + '.json.gz'), 'wb', compresslevel=9) as topology_file:
+            topology_file.write(data)
+        logging.info("%s: %d -> %d points, %d bytes" % (name, points, sum(len(arc) for arc in topology['arcs']), len(data)))
+
+def version(directory=TOPOJSON_DIR):
+    ''' Content hash of the topology files, for cache busting '''
+    return _version(directory, tuple(os.stat(os.path.join(directory, name + '.json')).st_mtime for name in NAMES))
+
+@functools.lru_cache(maxsize=1)
+def _version(directory, mtimes):
+    ''' mtimes is only part of the cache key, so re-fetched files are hashed again '''
+    digest = hashlib.sha1()
+    for name in NAMES:
+        with open(os.path.join(directory, name + '.json'), 'rb') as topology_file:
+            digest.update(topology_file.read())
+    return digest.hexdigest()[:10]
+
+def available(directory=TOPOJSON_DIR):
+    return all(os.path.exists(os.path.join(directory, name + '.json')) for name in NAMES)
+
+def init_app(server, graphconfig, url_base_pathname='/', directory=TOPOJSON_DIR):
+    if not available(directory):
+        logging.warning("No topojson files in %s, maps load them from %s" % (directory, CDN_URL))
+        return
+    url = url_base_pathname + 'topojson/%s/' % version(directory)
+
+    @server.route(url_base_pathname + 'topojson/<requested>/<name>.json')
+    def topojson(requested, name):
+        if name not in NAMES:
+            abort(404)
+        # Only the current files may be cached as immutable under their
+        # version; pages still holding an older one are sent to the current
+        # files with an uncached redirect
+        current = version(directory)
+        if requested != current:
+            return redirect(url_base_pathname + 'topojson/%s/%s.json' % (current, name))
+        path = name + '.json'
+        gzipped = 'gzip' in request.headers.get('Accept-Encoding', '') and os.path.exists(os.path.join(directory, path + '.gz'))
+        response = send_from_directory(os.path.abspath(directory), path + '.gz' if gzipped else path,
+                                       mimetype='application/json', max_age=max_age)
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % max_age
+        return response
+
+    # Every dcc.Graph shares this config, so plotly.js fetches from here
+    graphconfig['topojsonURL'] = url
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Download and simplify the map topology.')
+    parser.add_argument('--factor', type=int, default=4, help='grid coarsening of the world map (default: %(default)s, 1 keeps it as is)')
+    parser.add_argument('--output', default=TOPOJSON_DIR, help='directory to write (default: %(default)s)')
+    args = parser.parse_args()
+    fetch(args.output, args.factor)
+    print("Wrote %s, version %s" % (', '.join(NAMES), version(args.output)))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''
+Local vocabulary index for typeahead and for checking search terms before
+they are sent to Bookworm.
+
+The index is an Arrow file of the lower-cased words, sorted, with their corpus
+counts. The words column is a UTF-8 blob plus offsets, memory-mapped like the
+other local data files, so every worker shares one copy in the page cache and
+a prefix lookup is two binary searches. Build it offline, either from the
+Bookworm 'unigram' field or from a tab separated `word<TAB>count` file:
+
+    python vocab.py [--words wordcounts.tsv] [--min-count 5] [--output data/vocab.arrow]
+
+Running workers pick up a rebuilt index on their next lookup. Search terms are
+only rejected as unknown by an index built with the default --min-count 1, and
+only up to MAX_WORD_LENGTH characters; everything else goes to Bookworm.
+'''
+import argparse
+import bisect
+import difflib
+import functools
+import json
+import logging
+import os
+
+import numpy as np
+import pyarrow as pa
+
+VOCAB_PATH = 'data/vocab.arrow'
+
+# Longer tokens are OCR noise
+MAX_WORD_LENGTH = 30
+
+schema = pa.schema([('word', pa.large_string()), ('count', pa.int64())])
+
+def _bookworm_counts():
+    import bwypy
+
+    with open('config.json','r') as options_file:
+        bwypy_options = json.load(options_file)
+
+    bwypy.set_options(database=bwypy_options['settings']['dbname'], endpoint=bwypy_options['settings']['endpoint'])
+    bw = bwypy.BWQuery(verify_fields=False,verify_cert=False)
+    bw.counttype = ['WordCount']
+    bw.groups = ['unigram']
+    bw.search_limits = {}
+    df = bw.run().frame(index=False)
+    return zip(df.iloc[:, 0], df.iloc[:, 1])
+
+def _file_counts(path):
+    with open(path, 'r') as words_file:
+        for line in words_file:
+            word, _, count = line.rstrip('\n').partition('\t')
+            yield word, int(count or 0)
+
+def materialize(path=VOCAB_PATH, words=None, min_count=1):
+    counts = {}
+    for word, count in (_file_counts(words) if words else _bookworm_counts()):
+        word = word.strip().lower()
+        if word and len(word) <= MAX_WORD_LENGTH and count >= min_count:
+            counts[word] = counts.get(word, 0) + int(count)
+
+    # Sorted by code point, which is also the order of their UTF-8 bytes
+    vocab = sorted(counts)
+    batch = pa.RecordBatch.from_arrays([pa.array(vocab, pa.large_string()), pa.array([counts[word] for word in vocab], pa.int64())],
+                                       schema=schema)
+    # Write next to the target and swap, so running workers never see a partial file
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema.with_metadata({ 'min_count': str(min_count) })) as writer:
+            writer.write_batch(batch)
+    os.replace(tmp_path, path)
+    return len(vocab)
+
+def available(path=VOCAB_PATH):
+    return os.path.exists(path)
+
+class Words:
+    ''' The sorted words as UTF-8 bytes, read from the memory-mapped blob on access '''
+    def __init__(self, column):
+        offsets, blob = column.buffers()[1:]
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)[column.offset:column.offset + len(column) + 1]
+        # An empty index has no data buffer
+        self.blob = memoryview(blob if blob is not None else b'')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def word(self, i):
+        return self[i].decode('utf-8')
+
+@functools.lru_cache(maxsize=1)
+def load_vocab(path=VOCAB_PATH, mtime=None):
+    ''' Memory-map the index. mtime is only part of the cache key, so a rebuilt index is reloaded. '''
+    source = pa.memory_map(path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+    # Written as a single batch, so each column is one chunk
+    words = Words(table.column('word').chunk(0))
+    counts = table.column('count').chunk(0).to_numpy(zero_copy_only=True)
+    min_count = int(table.schema.metadata[b'min_count'])
+    return words, counts, min_count
+
+def _vocab(path=VOCAB_PATH):
+    return load_vocab(path, os.stat(path).st_mtime)
+
+def preload(path=VOCAB_PATH):
+    ''' Map the index now, e.g. in the gunicorn master so that workers inherit it '''
+    if available(path):
+        _vocab(path)
+
+def is_complete(path=VOCAB_PATH):
+    ''' True if the index has every word Bookworm has, up to MAX_WORD_LENGTH '''
+    return _vocab(path)[2] <= 1
+
+def _prefix_range(prefix, path=VOCAB_PATH):
+    ''' Index range of the words starting with prefix '''
+    words, counts, _ = _vocab(path)
+    prefix = prefix.encode('utf-8')
+    # 0xff never occurs in UTF-8, so sorts after every word with the prefix
+    return bisect.bisect_left(words, prefix), bisect.bisect_left(words, prefix + b'\xff')
+
+def _by_count(start, end, limit, path=VOCAB_PATH):
+    ''' The `limit` most frequent words in an index range, most frequent first '''
+    words, counts, _ = _vocab(path)
+    counts = counts[start:end]
+    top = np.arange(len(counts))
+    if len(counts) > limit:
+        top = np.argpartition(-counts, limit)[:limit]
+    top = top[np.argsort(-counts[top], kind='stable')]
+    return [words.word(start + i) for i in top]
+
+def most_frequent(n, path=VOCAB_PATH):
+    return _by_count(0, len(_vocab(path)[0]), n, path)
+
+def suggest(prefix, limit=10, path=VOCAB_PATH):
+    ''' The most frequent words starting with prefix '''
+    prefix = prefix.strip().lower()
+    if not prefix or not available(path):
+        return []
+    return _by_count(*_prefix_range(prefix, path), limit, path)
+
+def complete(text, limit=10, path=VOCAB_PATH):
+    ''' Completions of the last word of a comma separated search box entry '''
+    head, comma, last = (text or '').rpartition(',')
+    return [head + comma + word for word in suggest(last, limit, path)]
+
+def is_known(word, path=VOCAB_PATH):
+    words = _vocab(path)[0]
+    word = word.strip().lower().encode('utf-8')
+    i = bisect.bisect_left(words, word)
+    return i < len(words) and words[i] == word
+
+def unknown_words(tokens, path=VOCAB_PATH):
+    ''' Tokens that are not in the vocabulary. Everything passes without a complete index. '''
+    if not available(path) or not is_complete(path):
+        return []
+    # Longer words are left out of the index, not missing from Bookworm
+    return [token for token in tokens if len(token.strip()) <= MAX_WORD_LENGTH and not is_known(token, path)]
+
+def close_matches(word, limit=3, path=VOCAB_PATH):
+    ''' Spelling suggestions among the frequent words sharing the first letter '''
+    word = word.strip().lower()
+    if not word or not available(path):
+        return []
+    candidates = _by_count(*_prefix_range(word[0], path), 5000, path)
+    return difflib.get_close_matches(word, candidates, n=limit)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Build the local vocabulary index.')
+    parser.add_argument('--words', help='tab separated word<TAB>count file (default: query the Bookworm unigram field)')
+    parser.add_argument('--min-count', type=int, default=1, help='drop words rarer than this (default: %(default)s)')
+    parser.add_argument('--output', default=VOCAB_PATH, help='index file to write (default: %(default)s)')
+    args = parser.parse_args()
+    n = materialize(args.output, args.words, args.min_count)
+    print("Wrote %d words to %s" % (n, args.output))